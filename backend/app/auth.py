@@ -1,17 +1,35 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from .database import get_db, User
+from sqlalchemy.orm import Session, load_only
+from .database import get_db, run_db, User
+from .metrics import LatencyStats
 
 SECRET_KEY = "your-secret-key-here-change-in-production"
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Access tokens are checked without a database query, so they are kept short-lived
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "15"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "7"))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Everything request handlers read from current_user; the face columns stay in the database
+PRINCIPAL_COLUMNS = (User.id, User.username, User.email, User.full_name, User.role, User.is_active)
+
+# Hashes below BCRYPT_ROUNDS count as outdated and are replaced at the next login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# bcrypt releases the GIL, so each thread is a full core of hashing
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(os.cpu_count() or 1, 4))))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "256"))
+PASSWORD_HASH_RETRY_AFTER = int(os.getenv("PASSWORD_HASH_RETRY_AFTER", "1"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__default_rounds=BCRYPT_ROUNDS, bcrypt__min_rounds=BCRYPT_ROUNDS)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 def verify_password(plain_password, hashed_password):
@@ -20,19 +38,165 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+class PasswordHasher:
+    """Runs bcrypt on a small thread pool so logins never block the event loop
+
+    The pool size caps how many hashes run at once; requests beyond that
+    wait in the executor queue, and past max_pending they get a 503 rather
+    than an ever-growing backlog. Queue and hashing time are tracked
+    separately so a login burst shows up as queueing, not slow bcrypt.
+    """
+
+    def __init__(self, max_workers=PASSWORD_HASH_WORKERS, max_pending=PASSWORD_HASH_MAX_PENDING):
+        self.max_workers = max(max_workers, 1)
+        self.max_pending = max_pending
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.rehashed = 0
+        self.queue_stats = LatencyStats()
+        self.hash_stats = LatencyStats()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="bcrypt")
+
+    def _timed(self, submitted, fn, *args):
+        started = time.perf_counter()
+        self.queue_stats.record((started - submitted) * 1000.0)
+        try:
+            return fn(*args)
+        finally:
+            self.hash_stats.record((time.perf_counter() - started) * 1000.0)
+
+    async def run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many sign-ins in progress, please retry",
+                headers={"Retry-After": str(PASSWORD_HASH_RETRY_AFTER)},
+            )
+        self.pending += 1
+        ok = False
+        try:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self._executor, self._timed, time.perf_counter(), fn, *args)
+            ok = True
+            return result
+        finally:
+            self.pending -= 1
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    async def hash(self, password):
+        return await self.run(pwd_context.hash, password)
+
+    async def verify_and_update(self, password, hashed_password):
+        """(valid, new_hash); new_hash is set when the stored hash is below the current cost policy"""
+        return await self.run(pwd_context.verify_and_update, password, hashed_password)
+
+    def stats(self):
+        return {
+            "workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "rehashed": self.rehashed,
+            "bcrypt_rounds": BCRYPT_ROUNDS,
+            "queue": self.queue_stats.summary(),
+            "hash": self.hash_stats.summary()
+        }
+
+password_hasher = PasswordHasher()
+
+async def hash_password(password):
+    return await password_hasher.hash(password)
+
 def get_user(db: Session, username: str):
     return db.query(User).filter(User.username == username).first()
 
-def authenticate_user(db: Session, username: str, password: str):
-    user = get_user(db, username)
+async def authenticate_user(db: Session, username: str, password: str):
+    user = await run_db(get_user, db, username)
     if not user:
         return False
     if not user.is_active:
         return False
-    if not verify_password(password, user.hashed_password):
+    valid, new_hash = await password_hasher.verify_and_update(password, user.hashed_password)
+    if not valid:
         return False
+    if new_hash:
+        # The cost policy went up since this hash was made
+        user.hashed_password = new_hash
+        await run_db(db.commit)
+        await run_db(db.refresh, user)
+        password_hasher.rehashed += 1
     return user
 
+def load_principal(db: Session, username: str):
+    user = db.query(User).options(load_only(*PRINCIPAL_COLUMNS)).filter(User.username == username).first()
+    if user is None:
+        return None
+    return User(**{column.key: getattr(user, column.key) for column in PRINCIPAL_COLUMNS})
+
+class TokenRevocations:
+    """Per-user minimum token version, bumped when a user changes or is removed
+
+    Access tokens carry the user's token_version as a signed claim; any
+    token below the version recorded here is refused without a query. The
+    map is per process and starts empty, so after a restart (or in another
+    worker) a stale access token lives at most ACCESS_TOKEN_EXPIRE_MINUTES;
+    refresh always checks token_version against the database.
+    """
+
+    def __init__(self, keep_seconds=REFRESH_TOKEN_EXPIRE_DAYS * 86400):
+        self.keep_seconds = keep_seconds
+        self.refused = 0
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def revoke(self, user_id, version):
+        """Refuse tokens for user_id older than version"""
+        now = time.monotonic()
+        with self._lock:
+            current = self._versions.get(user_id, (0, now))[0]
+            self._versions[user_id] = (max(current, version), now)
+            # Past the refresh lifetime every token an entry could refuse has expired anyway
+            for stale in [uid for uid, (_, at) in self._versions.items() if now - at > self.keep_seconds]:
+                del self._versions[stale]
+
+    def revoke_all(self, user_id):
+        self.revoke(user_id, 1 << 62)
+
+    def is_revoked(self, user_id, version):
+        entry = self._versions.get(user_id)
+        if entry is not None and version < entry[0]:
+            self.refused += 1
+            return True
+        return False
+
+    def stats(self):
+        return {"users": len(self._versions), "refused": self.refused}
+
+token_revocations = TokenRevocations()
+
+def revoke_user_tokens(db: Session, user):
+    """Commit user's pending changes with a new token version, invalidating every token issued so far
+
+    Tokens are refused only once the commit succeeds; a failed commit is
+    rolled back and the old tokens stay valid.
+    """
+    version = (user.token_version or 0) + 1
+    user.token_version = version
+    try:
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    token_revocations.revoke(user.id, version)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -43,6 +207,61 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def create_user_tokens(user: User):
+    """A short-lived access token with the principal's claims, plus a refresh token"""
+    version = user.token_version or 0
+    access_token = create_access_token(
+        data={
+            "sub": user.username,
+            "typ": "access",
+            "uid": user.id,
+            "email": user.email,
+            "name": user.full_name,
+            "role": user.role,
+            "act": bool(user.is_active),
+            "ver": version
+        },
+        expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    )
+    refresh_token = create_access_token(
+        data={"sub": user.username, "typ": "refresh", "uid": user.id, "ver": version},
+        expires_delta=timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    )
+    return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
+
+def principal_from_claims(payload: dict):
+    """The detached principal for an access token carrying claims, or None for an old sub-only token"""
+    if "uid" not in payload:
+        return None
+    return User(
+        id=payload["uid"],
+        username=payload["sub"],
+        email=payload.get("email"),
+        full_name=payload.get("name"),
+        role=payload.get("role"),
+        is_active=payload.get("act", False)
+    )
+
+def refresh_user_tokens(db: Session, refresh_token: str):
+    """Swap a refresh token for a new token pair, returning (user, tokens)"""
+    refresh_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid refresh token",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        payload = jwt.decode(refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError as e:
+        print(f"JWT Error: {e}")
+        raise refresh_exception
+    if payload.get("typ") != "refresh" or "uid" not in payload:
+        raise refresh_exception
+
+    user = db.query(User).filter(User.id == payload["uid"]).first()
+    if not user or not user.is_active or (user.token_version or 0) != payload.get("ver"):
+        raise refresh_exception
+    return user, create_user_tokens(user)
+
 async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -60,7 +279,19 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     except JWTError as e:
         print(f"JWT Error: {e}")
         raise credentials_exception
-    user = get_user(db, username=username)
+    if payload.get("typ", "access") != "access":
+        raise credentials_exception
+
+    # Tokens with claims are answered without touching the database
+    user = principal_from_claims(payload)
+    if user is not None:
+        if token_revocations.is_revoked(user.id, payload.get("ver", 0)):
+            print(f"Token revoked: {username}")
+            raise credentials_exception
+        return user
+
+    # Sub-only tokens issued before the claims were added
+    user = await run_db(load_principal, db, username)
     if user is None:
         print(f"User not found: {username}")
         raise credentials_exception
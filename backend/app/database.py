@@ -1,13 +1,86 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Float, Boolean, ForeignKey, Text
+from sqlalchemy import create_engine, event, Column, Index, Integer, String, DateTime, Float, Boolean, ForeignKey, Text, LargeBinary
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, deferred
+from sqlalchemy.pool import QueuePool
 from datetime import datetime
+import functools
+import os
+import anyio
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./attendance.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+from .migrations import run_migrations
+
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./attendance.db")
+if SQLALCHEMY_DATABASE_URL.startswith("postgres://"):
+    SQLALCHEMY_DATABASE_URL = "postgresql://" + SQLALCHEMY_DATABASE_URL.split("://", 1)[1]
+IS_SQLITE = SQLALCHEMY_DATABASE_URL.startswith("sqlite")
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+# WAL lets readers carry on while attendance rows are written, and NORMAL
+# syncs only at checkpoints instead of on every commit (safe under WAL)
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+
+def _engine_options(url):
+    options = {"pool_recycle": DB_POOL_RECYCLE}
+    # Sizing only applies to queue pools; SQLAlchemy picks StaticPool or
+    # SingletonThreadPool for in-memory SQLite and those reject these options
+    url = make_url(url)
+    if issubclass(url.get_dialect().get_pool_class(url), QueuePool):
+        options["pool_size"] = DB_POOL_SIZE
+        options["max_overflow"] = DB_MAX_OVERFLOW
+        options["pool_timeout"] = DB_POOL_TIMEOUT
+    if IS_SQLITE:
+        options["connect_args"] = {"check_same_thread": False}
+    else:
+        options["pool_pre_ping"] = True
+    return options
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        # Negative cache_size is in KiB rather than pages
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    finally:
+        cursor.close()
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **_engine_options(SQLALCHEMY_DATABASE_URL))
+if IS_SQLITE:
+    event.listen(engine, "connect", _apply_sqlite_pragmas)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# Threads allowed into the database at once; more would only queue on the connection pool
+DB_MAX_CONCURRENCY = int(os.getenv("DB_MAX_CONCURRENCY", str(DB_POOL_SIZE + DB_MAX_OVERFLOW)))
+
+def database_settings():
+    """Effective engine settings, with SQLite pragmas read back from a live connection"""
+    settings = {
+        "url": engine.url.render_as_string(hide_password=True),
+        "pool": type(engine.pool).__name__,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "max_concurrency": DB_MAX_CONCURRENCY
+    }
+    if IS_SQLITE:
+        with engine.connect() as conn:
+            for pragma in ("journal_mode", "synchronous", "busy_timeout", "mmap_size", "cache_size"):
+                settings[pragma] = conn.exec_driver_sql(f"PRAGMA {pragma}").scalar()
+    return settings
+
 class User(Base):
     __tablename__ = "users"
     
@@ -18,12 +91,17 @@ class User(Base):
     hashed_password = Column(String)
     role = Column(String, default="student")  # admin, teacher, student
     is_active = Column(Boolean, default=True)
-    face_encoding = Column(Text)
-    face_image = Column(Text)  # Base64 encoded face image
+    # The face columns are deferred: only the face paths load them, with undefer_group("face")
+    face_encoding = deferred(Column(Text), group="face")  # Legacy JSON encoding, superseded by face_encoding_blob
+    face_encoding_blob = deferred(Column(LargeBinary), group="face")  # Packed by face_encoding_codec, centroid of face_templates
+    face_templates = deferred(Column(LargeBinary), group="face")  # Every enrolled encoding, packed as one (k, 128) block
+    face_image = deferred(Column(Text), group="face")  # Base64 encoded face image
+    face_updated_at = deferred(Column(DateTime), group="face")  # Set on every encoding change, so a stale gallery snapshot is noticed
     phone_number = Column(String)  # User's phone number
     parent_phone = Column(String)  # Parent's phone number (for students)
     emergency_contact = Column(String)  # Emergency contact number
     notification_preferences = Column(String, default="email,sms")  # JSON string
+    token_version = Column(Integer, default=0, nullable=False)  # Bumped to revoke every token issued so far
     created_at = Column(DateTime, default=datetime.utcnow)
     
     attendances = relationship("Attendance", back_populates="user")
@@ -58,6 +136,10 @@ class Enrollment(Base):
     
     user = relationship("User")
     class_obj = relationship("Class", back_populates="enrollments")
+    
+    __table_args__ = (
+        Index("ux_enrollments_user_class", "user_id", "class_id", unique=True),
+    )
 
 class Attendance(Base):
     __tablename__ = "attendances"
@@ -74,6 +156,13 @@ class Attendance(Base):
     
     user = relationship("User", back_populates="attendances")
     class_obj = relationship("Class", back_populates="attendances")
+    
+    # Duplicate check, class listings and trends; added to older databases by migration 3
+    __table_args__ = (
+        Index("ix_attendances_user_class_time", "user_id", "class_id", "timestamp"),
+        Index("ix_attendances_class_time", "class_id", "timestamp"),
+        Index("ix_attendances_time", "timestamp"),
+    )
 
 def get_db():
     db = SessionLocal()
@@ -82,4 +171,18 @@ def get_db():
     finally:
         db.close()
 
-Base.metadata.create_all(bind=engine)
\ No newline at end of file
+_db_limiter = None
+
+async def run_db(fn, *args, **kwargs):
+    """Run sync database code on a worker thread, at most DB_MAX_CONCURRENCY at a time
+
+    Endpoints that await other work (bcrypt, the face pool) use this for
+    their queries so the event loop never waits on SQLite.
+    """
+    global _db_limiter
+    if _db_limiter is None:
+        _db_limiter = anyio.CapacityLimiter(DB_MAX_CONCURRENCY)
+    return await anyio.to_thread.run_sync(functools.partial(fn, *args, **kwargs), limiter=_db_limiter)
+
+Base.metadata.create_all(bind=engine)
+run_migrations(engine)
\ No newline at end of file
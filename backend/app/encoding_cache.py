@@ -0,0 +1,130 @@
+import asyncio
+import base64
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+FACE_CACHE_TTL_SECONDS = float(os.getenv("FACE_CACHE_TTL_SECONDS", "300"))
+FACE_CACHE_MAX_BYTES = int(os.getenv("FACE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# Rough per-entry bookkeeping cost on top of the stored vector
+ENTRY_OVERHEAD_BYTES = 256
+
+def image_bytes(image):
+    """Raw image bytes from a base64 data URL or an uploaded file's bytes"""
+    if isinstance(image, str):
+        return base64.b64decode(image.split(',')[1])
+    return image
+
+class EncodingCache:
+    """Bounded LRU of encoding results keyed by a hash of the decoded image bytes
+
+    Stores the encoding, "no face" (None) or the FrameQualityError, so a
+    retried upload gets the same answer without touching the pipeline.
+    Identical requests that arrive while the first is still running wait
+    for it instead of starting a second encode.
+    """
+
+    def __init__(self, ttl_seconds=FACE_CACHE_TTL_SECONDS, max_bytes=FACE_CACHE_MAX_BYTES):
+        self.ttl = ttl_seconds
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_bytes > 0
+
+    def key(self, image_data):
+        return hashlib.blake2b(image_data, digest_size=16).digest()
+
+    def _entry_size(self, value):
+        return ENTRY_OVERHEAD_BYTES + (value.nbytes if isinstance(value, np.ndarray) else 0)
+
+    def get(self, key):
+        """Return (hit, value); value is an encoding list, None or an exception"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires >= time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value.tolist() if isinstance(value, np.ndarray) else value
+                del self._entries[key]
+                self.size_bytes -= self._entry_size(value)
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        if isinstance(value, list):
+            value = np.asarray(value, dtype=np.float64)
+        size = self._entry_size(value)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size_bytes -= self._entry_size(previous[1])
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self.size_bytes += size
+            while self.size_bytes > self.max_bytes and self._entries:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size_bytes -= self._entry_size(evicted)
+                self.evictions += 1
+
+    async def get_or_compute(self, image_data, compute):
+        """Serve from cache, join an identical in-flight request, or await compute(image_data)"""
+        if not self.enabled:
+            return await compute(image_data)
+
+        key = self.key(image_data)
+        hit, value = self.get(key)
+        if not hit:
+            inflight = self._inflight.get(key)
+            if inflight is not None:
+                value = await asyncio.shield(inflight)
+            else:
+                inflight = self._inflight[key] = asyncio.ensure_future(self._compute(key, image_data, compute))
+                try:
+                    value = await asyncio.shield(inflight)
+                finally:
+                    self._inflight.pop(key, None)
+
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    async def _compute(self, key, image_data, compute):
+        try:
+            value = await compute(image_data)
+        except Exception as e:
+            # Only deterministic rejections are worth remembering; pool
+            # saturation and the like must be retried for real
+            if getattr(e, "cacheable", False):
+                self.put(key, e)
+                return e
+            raise
+        self.put(key, value)
+        return value
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "size_bytes": self.size_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+encoding_cache = EncodingCache()
@@ -0,0 +1,182 @@
+import numpy as np
+
+CHUNK_ROWS = 8192
+
+def _nearest_centroids(vectors, centroids, centroid_sq_norms):
+    # Chunked so assigning a few hundred thousand vectors never materialises
+    # the full N x nlist distance matrix
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), CHUNK_ROWS):
+        chunk = vectors[start:start + CHUNK_ROWS]
+        distances = centroid_sq_norms - 2.0 * (chunk @ centroids.T)
+        assignments[start:start + CHUNK_ROWS] = np.argmin(distances, axis=1)
+    return assignments
+
+def kmeans(vectors, k, iterations=10, seed=0):
+    """Plain Lloyd's k-means returning (k, dim) float32 centroids"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    k = min(k, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = _nearest_centroids(vectors, centroids, np.einsum("ij,ij->i", centroids, centroids))
+        counts = np.bincount(assignments, minlength=k)
+        sums = np.stack([np.bincount(assignments, weights=vectors[:, d], minlength=k) for d in range(vectors.shape[1])], axis=1)
+
+        filled = counts > 0
+        centroids[filled] = (sums[filled] / counts[filled, None]).astype(np.float32)
+        # Re-seed empty clusters from random points instead of losing them
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+    return centroids
+
+class IVFIndex:
+    """Inverted-file index: a k-means coarse quantizer with one id list per centroid
+
+    Search scans only the nprobe lists whose centroids are closest to the
+    probe, so cost scales with N * nprobe / nlist instead of N. Results are
+    approximate; raise nprobe to trade latency for recall.
+
+    Ids are small non-negative integers. By default each list keeps its own
+    copy of the vectors. Given vectors, a callable returning the current
+    (encodings, sq_norms) arrays indexed by id, the lists hold only ids and
+    search reads the probed rows from those arrays. The face gallery uses
+    that with matrix row numbers as ids, so the index adds no copy of the
+    shared matrix to each worker.
+    """
+
+    def __init__(self, dim=128, nprobe=32, vectors=None):
+        self.dim = dim
+        self.nprobe = nprobe
+        self.vectors = vectors
+        self.trained_size = 0
+        self.centroids = np.empty((0, dim), dtype=np.float32)
+        self._centroid_sq_norms = np.empty(0, dtype=np.float32)
+        self._ids = []
+        self._vectors = []
+        self._sq_norms = []
+        self._sizes = []
+        # id -> list number, -1 when the id is not in the index
+        self._lists = np.full(0, -1, dtype=np.int32)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    def train(self, vectors, nlist=None, iterations=8, sample_size=None, seed=0):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if nlist is None:
+            nlist = max(int(4 * np.sqrt(len(vectors))), 1)
+        # k-means quality saturates well before every vector is used
+        sample_size = sample_size or nlist * 32
+        if len(vectors) > sample_size:
+            vectors = vectors[np.random.default_rng(seed).choice(len(vectors), sample_size, replace=False)]
+
+        self.centroids = kmeans(vectors, nlist, iterations, seed)
+        self._centroid_sq_norms = np.einsum("ij,ij->i", self.centroids, self.centroids)
+        self.trained_size = len(vectors)
+        self._ids = [np.empty(0, dtype=np.int64) for _ in range(self.nlist)]
+        if self.vectors is None:
+            self._vectors = [np.empty((0, self.dim), dtype=np.float32) for _ in range(self.nlist)]
+            self._sq_norms = [np.empty(0, dtype=np.float32) for _ in range(self.nlist)]
+        self._sizes = [0] * self.nlist
+        self._lists = np.full(0, -1, dtype=np.int32)
+        self._count = 0
+
+    def _stores(self):
+        return (self._ids,) if self.vectors is not None else (self._ids, self._vectors, self._sq_norms)
+
+    def _append(self, list_no, ids, vectors):
+        size = self._sizes[list_no]
+        end = size + len(ids)
+        if end > len(self._ids[list_no]):
+            capacity = max(2 * len(self._ids[list_no]), end, 16)
+            for store in self._stores():
+                grown = np.zeros((capacity,) + store[list_no].shape[1:], dtype=store[list_no].dtype)
+                grown[:size] = store[list_no][:size]
+                store[list_no] = grown
+        self._ids[list_no][size:end] = ids
+        if self.vectors is None:
+            self._vectors[list_no][size:end] = vectors
+            self._sq_norms[list_no][size:end] = np.einsum("ij,ij->i", vectors, vectors)
+        self._sizes[list_no] = end
+        self._lists[ids] = list_no
+        self._count += len(ids)
+
+    def add(self, ids, vectors):
+        """Insert vectors (replacing any existing entry with the same id)"""
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if len(ids) == 0:
+            return
+        top = int(ids.max()) + 1
+        if top > len(self._lists):
+            grown = np.full(max(top, 2 * len(self._lists)), -1, dtype=np.int32)
+            grown[:len(self._lists)] = self._lists
+            self._lists = grown
+        for item_id in ids[self._lists[ids] >= 0].tolist():
+            self.remove(item_id)
+
+        # Group by list so each inverted list grows with one slice copy
+        assignments = _nearest_centroids(vectors, self.centroids, self._centroid_sq_norms)
+        order = np.argsort(assignments, kind="stable")
+        lists, starts = np.unique(assignments[order], return_index=True)
+        for list_no, chunk in zip(lists.tolist(), np.split(order, starts[1:])):
+            self._append(list_no, ids[chunk], vectors[chunk])
+
+    def remove(self, item_id):
+        item_id = int(item_id)
+        if item_id >= len(self._lists) or self._lists[item_id] < 0:
+            return False
+        list_no = int(self._lists[item_id])
+        last = self._sizes[list_no] - 1
+        # Lists hold ~N / nlist ids, so finding the slot by scan is cheap
+        pos = int(np.flatnonzero(self._ids[list_no][:last + 1] == item_id)[0])
+        if pos != last:
+            for store in self._stores():
+                store[list_no][pos] = store[list_no][last]
+        self._sizes[list_no] = last
+        self._lists[item_id] = -1
+        self._count -= 1
+        return True
+
+    def search(self, probe, nprobe=None):
+        """Return (id, distance) of the nearest vector found in the probed lists, or (None, None)"""
+        probe = np.asarray(probe, dtype=np.float32).reshape(self.dim)
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        if nprobe == 0:
+            return None, None
+
+        centroid_distances = self._centroid_sq_norms - 2.0 * (self.centroids @ probe)
+        if nprobe < self.nlist:
+            probed = np.argpartition(centroid_distances, nprobe - 1)[:nprobe]
+        else:
+            probed = np.arange(self.nlist)
+        if self.vectors is not None:
+            encodings, sq_norms = self.vectors()
+
+        best_id, best_sq = None, np.inf
+        for list_no in probed:
+            size = self._sizes[list_no]
+            if size == 0:
+                continue
+            ids = self._ids[list_no][:size]
+            if self.vectors is not None:
+                vectors, norms = encodings[ids], sq_norms[ids]
+            else:
+                vectors, norms = self._vectors[list_no][:size], self._sq_norms[list_no][:size]
+            sq_distances = norms - 2.0 * (vectors @ probe)
+            pos = int(np.argmin(sq_distances))
+            if sq_distances[pos] < best_sq:
+                best_sq = float(sq_distances[pos])
+                best_id = int(ids[pos])
+
+        if best_id is None:
+            return None, None
+        return best_id, float(np.sqrt(max(best_sq + float(probe @ probe), 0.0)))
@@ -0,0 +1,71 @@
+import json
+import os
+import struct
+import numpy as np
+
+# Stored layout: 8 byte header (format code, padding, float32 scale)
+# followed by the raw little-endian vector, so decoding is a single
+# np.frombuffer over the column value with no text parsing.
+HEADER = struct.Struct("<B3xf")
+
+FLOAT32 = 1
+FLOAT16 = 2
+INT8 = 3
+
+STORAGE_FORMATS = {"float32": FLOAT32, "float16": FLOAT16, "int8": INT8}
+DTYPES = {FLOAT32: np.dtype("<f4"), FLOAT16: np.dtype("<f2"), INT8: np.dtype("i1")}
+
+FACE_ENCODING_STORAGE = os.getenv("FACE_ENCODING_STORAGE", "float32")
+
+def pack_encoding(encoding, storage=None):
+    """Serialise an encoding to compact bytes for the face_encoding_blob column"""
+    code = STORAGE_FORMATS[storage or FACE_ENCODING_STORAGE]
+    vector = np.asarray(encoding, dtype=np.float32).ravel()
+    scale = 1.0
+
+    if code == INT8:
+        peak = float(np.abs(vector).max()) if vector.size else 0.0
+        scale = peak / 127.0 if peak > 0 else 1.0
+        vector = np.clip(np.rint(vector / scale), -127, 127)
+
+    return HEADER.pack(code, scale) + vector.astype(DTYPES[code]).tobytes()
+
+def unpack_encoding(data):
+    """Decode a stored encoding; float32 blobs come back as a zero-copy view"""
+    if isinstance(data, str):
+        # Legacy JSON text from before the binary column existed
+        return np.asarray(json.loads(data), dtype=np.float32)
+
+    code, scale = HEADER.unpack_from(data)
+    vector = np.frombuffer(data, dtype=DTYPES[code], offset=HEADER.size)
+    if code == FLOAT32:
+        return vector
+    if code == INT8:
+        return vector.astype(np.float32) * np.float32(scale)
+    return vector.astype(np.float32)
+
+def stored_encoding(user):
+    """Return a user's face encoding as a float32 vector, or None if not enrolled"""
+    if user.face_encoding_blob is not None:
+        return unpack_encoding(user.face_encoding_blob)
+    if user.face_encoding:
+        return unpack_encoding(user.face_encoding)
+    return None
+
+def pack_templates(templates, storage=None):
+    """Serialise a (k, dim) stack of encodings for the face_templates column"""
+    return pack_encoding(np.asarray(templates, dtype=np.float32), storage)
+
+def unpack_templates(data, dim=128):
+    """Decode a face_templates value to a (k, dim) float32 array"""
+    return unpack_encoding(data).reshape(-1, dim)
+
+def stored_templates(user):
+    """Return a user's enrolled templates as a (k, dim) array, or None if not enrolled"""
+    if user.face_templates is not None:
+        return unpack_templates(user.face_templates)
+    encoding = stored_encoding(user)
+    if encoding is None:
+        return None
+    # Enrolled before templates existed: the single encoding is the only template
+    return encoding.reshape(1, -1)
@@ -0,0 +1,448 @@
+import hashlib
+import os
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+
+from .face_encoding_codec import unpack_encoding, stored_encoding
+from .face_ann import IVFIndex
+from .face_store import SharedEncodingStore
+
+ENCODING_DIM = 128
+# Directory of the memory-mapped store shared by every worker process
+# (empty keeps the gallery private to the process)
+SNAPSHOT_DIR = os.getenv("FACE_GALLERY_SNAPSHOT_DIR", "./face_gallery")
+# Whole-gallery searches (no class_id) switch from exact brute force to
+# the IVF index once this many faces are enrolled (0 disables the index).
+# The index is built on the first such search, so workers that only match
+# class rosters never train one.
+FACE_ANN_MIN_SIZE = int(os.getenv("FACE_ANN_MIN_SIZE", "50000"))
+FACE_ANN_NPROBE = int(os.getenv("FACE_ANN_NPROBE", "32"))
+
+def face_stamp(updated_at):
+    """A face_updated_at datetime as whole microseconds since the epoch (0 for None)"""
+    if updated_at is None:
+        return 0
+    return (updated_at - datetime(1970, 1, 1)) // timedelta(microseconds=1)
+
+class FaceGallery:
+    """1:N index over every enrolled face encoding
+
+    The matrix lives in a SharedEncodingStore, so uvicorn workers started
+    from the same directory share one copy and see each other's writes.
+    Per-process state (the id -> row map, roster row caches and the IVF
+    index) is rebuilt lazily when the store's generation moves. The IVF
+    lists hold row numbers and read vectors from the shared matrix.
+    """
+
+    def __init__(self, dim=ENCODING_DIM, snapshot_dir=None):
+        self.dim = dim
+        self.snapshot_dir = snapshot_dir
+        self._lock = threading.RLock()
+        self._store = None
+        self._rows = {}
+        self._rows_generation = None
+        self._rosters = {}
+        self._rosters_generation = None
+        self._class_rows = {}
+        self._ann = None
+        self._ann_generation = None
+        self._ann_rebuilding = False
+
+    @property
+    def store(self):
+        # Opened on first use so importing the module never touches the disk
+        if self._store is None:
+            with self._lock:
+                if self._store is None:
+                    store = SharedEncodingStore(self.dim, self.snapshot_dir)
+                    self._rosters_generation = store.roster_generation
+                    self._store = store
+        return self._store
+
+    @property
+    def generation(self):
+        return self.store.generation
+
+    def _read(self, fn):
+        # One thread at a time per process: a remap after another worker
+        # grew the store must not happen under a concurrent search
+        with self._lock:
+            return self.store.read(fn)
+
+    def __len__(self):
+        return self._read(lambda count: count)
+
+    @property
+    def user_ids(self):
+        return self._read(lambda count: self.store.user_ids[:count].copy())
+
+    @property
+    def encodings(self):
+        return self._read(lambda count: self.store.encodings[:count].copy())
+
+    def _sync_rows(self):
+        # Caller holds self._lock and is inside store.read or the store lock
+        generation = self.store.generation
+        if self._rows_generation != generation:
+            count = self.store.count
+            self._rows = {int(user_id): row for row, user_id in enumerate(self.store.user_ids[:count].tolist())}
+            self._rows_generation = generation
+            self._class_rows = {}
+
+    def _schedule_ann_rebuild(self):
+        if self._ann_rebuilding:
+            return
+        self._ann_rebuilding = True
+        threading.Thread(target=self._rebuild_ann, daemon=True).start()
+
+    def _rebuild_ann(self):
+        try:
+            generation, user_ids, encodings = self._read(lambda count: (
+                self.store.generation, self.store.user_ids[:count].copy(), self.store.encodings[:count].copy()
+            ))
+            # Training runs outside the lock on a transient copy; searches
+            # use exact scans meanwhile
+            if FACE_ANN_MIN_SIZE <= 0 or len(user_ids) < FACE_ANN_MIN_SIZE:
+                ann = None
+            else:
+                ann = IVFIndex(self.dim, nprobe=FACE_ANN_NPROBE, vectors=lambda: (self.store.encodings, self.store.sq_norms))
+                ann.train(encodings)
+                ann.add(np.arange(len(user_ids)), encodings)
+            with self._lock:
+                self._ann = ann
+                self._ann_generation = generation
+        finally:
+            self._ann_rebuilding = False
+
+    def _ann_ready(self):
+        """True if the IVF index reflects the current store, scheduling a rebuild if it does not"""
+        if FACE_ANN_MIN_SIZE <= 0:
+            return False
+        generation = self.store.generation
+        if self._ann_generation == generation:
+            return self._ann is not None
+        if self._ann is not None or self.store.count >= FACE_ANN_MIN_SIZE:
+            # Another worker wrote to the store; search exactly until caught up
+            self._schedule_ann_rebuild()
+        return False
+
+    def _write_all(self, user_ids, encodings, database_id=None, stamp=0):
+        store = self.store
+        with self._lock, store.lock:
+            store.begin_write()
+            count = store.count
+            try:
+                store.reserve(len(user_ids))
+                count = len(user_ids)
+                store.user_ids[:count] = user_ids
+                store.encodings[:count] = encodings
+                store.sq_norms[:count] = np.einsum("ij,ij->i", encodings, encodings)
+            finally:
+                store.end_write(count, initialized=True, database_id=database_id, face_stamp=stamp)
+                self._rows_generation = None
+                self._ann = None
+                self._ann_generation = None
+
+    def build(self, user_ids, encodings):
+        """Replace the whole gallery"""
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, self.dim)
+        self._write_all(user_ids, encodings)
+
+    def build_index(self):
+        """Build the IVF index now instead of on the first whole-gallery search"""
+        self._rebuild_ann()
+        return self._ann is not None
+
+    def _begin_write(self):
+        # Caller holds self._lock and store.lock
+        store = self.store
+        store.refresh()
+        self._sync_rows()
+        ann_current = self._ann is not None and self._ann_generation == store.generation
+        store.begin_write()
+        return ann_current
+
+    def _end_write(self, count, ann_current, ok, stamp=None):
+        store = self.store
+        store.end_write(count, face_stamp=stamp)
+        # Our own write keeps the local caches current; a failed one forces a resync
+        self._rows_generation = store.generation if ok else None
+        if ann_current and ok:
+            self._ann_generation = store.generation
+
+    def upsert(self, user_id, encoding, updated_at=None):
+        """Insert or replace a single user's encoding in place
+
+        updated_at is the user's face_updated_at; the newest one written is
+        kept in the store so load() can tell an offline re-enrolment apart.
+        """
+        if isinstance(encoding, (str, bytes, memoryview)):
+            encoding = unpack_encoding(encoding)
+        encoding = np.asarray(encoding, dtype=np.float32).reshape(self.dim)
+        user_id = int(user_id)
+        store = self.store
+
+        with self._lock, store.lock:
+            ann_current = self._begin_write()
+            count = store.count
+            ok = False
+            try:
+                row = self._rows.get(user_id)
+                if row is None:
+                    store.reserve(count + 1)
+                    row = count
+                    self._rows[user_id] = row
+                    self._class_rows = {}
+                store.user_ids[row] = user_id
+                store.encodings[row] = encoding
+                store.sq_norms[row] = encoding @ encoding
+                count = max(count, row + 1)
+                if self._ann is not None:
+                    self._ann.add([row], encoding)
+                ok = True
+            finally:
+                self._end_write(count, ann_current, ok, max(store.face_stamp, face_stamp(updated_at)))
+
+    def remove(self, user_id):
+        """Drop a user's encoding, moving the last row into the freed slot"""
+        user_id = int(user_id)
+        store = self.store
+
+        with self._lock, store.lock:
+            store.refresh()
+            self._sync_rows()
+            if user_id not in self._rows:
+                return False
+
+            ann_current = self._begin_write()
+            count = store.count
+            ok = False
+            try:
+                row = self._rows.pop(user_id)
+                last = count - 1
+                if row != last:
+                    store.user_ids[row] = store.user_ids[last]
+                    store.encodings[row] = store.encodings[last]
+                    store.sq_norms[row] = store.sq_norms[last]
+                    self._rows[int(store.user_ids[row])] = row
+                count = last
+                self._class_rows = {}
+                if self._ann is not None:
+                    self._ann.remove(last)
+                    if row != last:
+                        self._ann.add([row], store.encodings[row])
+                ok = True
+            finally:
+                self._end_write(count, ann_current, ok)
+            return True
+
+    def sync_user(self, user):
+        """Bring the gallery in line with a user row after it was changed"""
+        encoding = stored_encoding(user) if user.is_active else None
+        if encoding is not None:
+            self.upsert(user.id, encoding, user.face_updated_at)
+        else:
+            self.remove(user.id)
+
+    def load_rosters(self, db):
+        """Load class_id -> enrolled user ids, used to narrow identification to one class"""
+        from .database import Enrollment
+
+        # Query under the lock so an enroll() racing a background load is not lost
+        with self._lock:
+            generation = self.store.roster_generation
+            rosters = {}
+            for user_id, class_id in db.query(Enrollment.user_id, Enrollment.class_id).all():
+                rosters.setdefault(class_id, set()).add(user_id)
+            self._rosters = rosters
+            self._rosters_generation = generation
+            self._class_rows = {}
+
+    def _sync_rosters(self):
+        # Another worker enrolled someone; its roster change is in the database
+        if self._rosters_generation != self.store.roster_generation:
+            from .database import SessionLocal
+
+            db = SessionLocal()
+            try:
+                self.load_rosters(db)
+            finally:
+                db.close()
+
+    def _roster_changed(self, class_id, apply):
+        with self._lock:
+            before, after = self.store.bump_rosters()
+            apply(self._rosters)
+            self._class_rows.pop(class_id, None)
+            # Only skip the reload if no other worker changed rosters since ours were loaded
+            if self._rosters_generation == before:
+                self._rosters_generation = after
+
+    def enroll(self, class_id, user_id):
+        self._roster_changed(class_id, lambda rosters: rosters.setdefault(class_id, set()).add(int(user_id)))
+
+    def class_rows(self, class_id):
+        """Row indexes of a class roster in the encoding matrix, cached until rows move"""
+        with self._lock:
+            self._sync_rosters()
+            self._sync_rows()
+            rows = self._class_rows.get(class_id)
+            if rows is None:
+                members = self._rosters.get(class_id, ())
+                rows = np.array(sorted(self._rows[u] for u in members if u in self._rows), dtype=np.int64)
+                self._class_rows[class_id] = rows
+            return rows
+
+    def _gallery_users(self, db, columns):
+        # Imported here so pool workers can load the face stack without
+        # touching the database module and its create_all/migration side effects
+        from .database import User
+
+        return db.query(*columns(User)).filter(
+            User.face_encoding_blob.isnot(None),
+            User.is_active == True
+        )
+
+    def _scan_db(self, db):
+        rows = self._gallery_users(db, lambda User: (User.id, User.face_encoding_blob, User.face_updated_at)).all()
+
+        user_ids = []
+        encodings = []
+        stamp = 0
+        for user_id, blob, updated_at in rows:
+            stamp = max(stamp, face_stamp(updated_at))
+            encoding = unpack_encoding(blob)
+            if len(encoding) != self.dim:
+                continue
+            user_ids.append(user_id)
+            encodings.append(encoding)
+        return np.array(user_ids, dtype=np.int64), np.array(encodings, dtype=np.float32).reshape(-1, self.dim), stamp
+
+    def _database_id(self, db):
+        url = db.get_bind().url.render_as_string(hide_password=False)
+        return int.from_bytes(hashlib.blake2b(url.encode(), digest_size=8).digest(), "little")
+
+    def _matches_db(self, db, database_id):
+        """True if the store was loaded from this database and still holds the same users
+
+        Compares the count, max and sum of user ids, plus the newest
+        face_updated_at so an encoding replaced while the store was offline
+        is caught too; one aggregate query rather than a scan of the
+        encodings. Removing the newest face leaves the store's stamp ahead
+        of the database, which costs one extra rebuild at the next start.
+        Caller holds the store lock.
+        """
+        from sqlalchemy import func
+
+        store = self.store
+        if not store.initialized or store.database_id != database_id:
+            return False
+        count, max_id, sum_id, updated_at = self._gallery_users(
+            db, lambda User: (func.count(User.id), func.max(User.id), func.sum(User.id), func.max(User.face_updated_at))
+        ).one()
+        if face_stamp(updated_at) != store.face_stamp:
+            return False
+        user_ids = store.user_ids[:store.count]
+        if count != len(user_ids):
+            return False
+        return count == 0 or (max_id == int(user_ids.max()) and sum_id == int(user_ids.sum()))
+
+    def load(self, db):
+        """Attach to the shared store, filling it from the database if it is empty or stale"""
+        self.load_rosters(db)
+        store = self.store
+        database_id = self._database_id(db)
+        with self._lock, store.lock:
+            store.refresh()
+            # The first worker to get here does the table scan; the others
+            # find it published and just map the file. A snapshot left from
+            # another, restored or since-edited database is rebuilt.
+            if not self._matches_db(db, database_id):
+                if store.initialized:
+                    print("Face gallery snapshot does not match the database, rebuilding it")
+                user_ids, encodings, stamp = self._scan_db(db)
+                self._write_all(user_ids, encodings, database_id=database_id, stamp=stamp)
+        return len(self)
+
+    def nearest(self, probe, class_id=None):
+        """Return (user_id, distance) of the closest enrolled face regardless of tolerance, or (None, None)
+
+        With class_id only that class roster is searched.
+        """
+        probe = np.asarray(probe, dtype=np.float32).reshape(self.dim)
+        store = self.store
+
+        def search(count):
+            if class_id is None:
+                encodings, sq_norms, user_ids = store.encodings[:count], store.sq_norms[:count], store.user_ids[:count]
+            else:
+                rows = self.class_rows(class_id)
+                encodings, sq_norms, user_ids = store.encodings[rows], store.sq_norms[rows], store.user_ids[rows]
+            if len(user_ids) == 0:
+                return None, None
+
+            # ||g - p||^2 = ||g||^2 - 2 g.p + ||p||^2
+            sq_distances = sq_norms - 2.0 * (encodings @ probe) + probe @ probe
+            best = int(np.argmin(sq_distances))
+            return int(user_ids[best]), float(sq_distances[best])
+
+        def search_ann(count):
+            if self._ann_generation != store.generation:
+                # Another worker wrote since _ann_ready and rows may have moved
+                return search(count)
+            row, distance = self._ann.search(probe)
+            if row is None:
+                return None, None
+            return int(store.user_ids[row]), distance * distance
+
+        with self._lock:
+            use_ann = class_id is None and self._ann_ready()
+            user_id, sq_distance = store.read(search_ann if use_ann else search)
+        if user_id is None:
+            return None, None
+        return user_id, float(np.sqrt(max(sq_distance, 0.0)))
+
+    def identify(self, probe, tolerance=0.6, class_id=None):
+        """Return (user_id, distance) of the closest enrolled face, user_id is None if nothing is within tolerance"""
+        user_id, distance = self.nearest(probe, class_id)
+        if user_id is None or distance > tolerance:
+            return None, distance
+        return user_id, distance
+
+    def match_roster(self, probes, class_id, tolerance=0.6):
+        """One-to-one match of several probes against a class roster
+
+        Builds the full probes x roster distance matrix in one product, then
+        assigns pairs greedily from the closest down so no face is given two
+        students and no student two faces. Returns a list of
+        (probe_index, user_id, distance) for pairs within tolerance.
+        """
+        probes = np.asarray(probes, dtype=np.float32).reshape(-1, self.dim)
+        store = self.store
+
+        def roster(count):
+            rows = self.class_rows(class_id)
+            return store.encodings[rows], store.sq_norms[rows], store.user_ids[rows]
+
+        encodings, sq_norms, user_ids = self._read(roster)
+        if len(probes) == 0 or len(user_ids) == 0:
+            return []
+
+        sq_distances = sq_norms[None, :] - 2.0 * (probes @ encodings.T) + np.einsum("ij,ij->i", probes, probes)[:, None]
+        distances = np.sqrt(np.maximum(sq_distances, 0.0))
+
+        candidates = np.argwhere(distances <= tolerance)
+        order = np.argsort(distances[candidates[:, 0], candidates[:, 1]], kind="stable")
+        matches = []
+        taken_probes, taken_users = set(), set()
+        for probe_index, column in candidates[order].tolist():
+            if probe_index in taken_probes or column in taken_users:
+                continue
+            taken_probes.add(probe_index)
+            taken_users.add(column)
+            matches.append((probe_index, int(user_ids[column]), float(distances[probe_index, column])))
+        return matches
+
+face_gallery = FaceGallery(snapshot_dir=SNAPSHOT_DIR)
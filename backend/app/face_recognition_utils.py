@@ -1,56 +1,307 @@
 import cv2
 import face_recognition
 import numpy as np
-import base64
-from io import BytesIO
-from PIL import Image
-import json
+import os
+import time
+
+from .face_gallery import face_gallery
+from .face_encoding_codec import unpack_encoding
+from .frame_quality import check_frame_quality, FrameQualityError
+from .encoding_cache import image_bytes
+from .face_templates import near_boundary, best_template_distance
+from .face_tracking import iou
+
+FACE_DETECTION_MODEL = os.getenv("FACE_DETECTION_MODEL", "hog")
+# Detection runs on a copy no wider than this (0 keeps full resolution);
+# upsampling lets the detector still find small faces on that copy.
+FACE_DETECTION_WIDTH = int(os.getenv("FACE_DETECTION_WIDTH", "640"))
+FACE_DETECTION_UPSAMPLE = int(os.getenv("FACE_DETECTION_UPSAMPLE", "1"))
+# Faces in a classroom photo are a few dozen pixels wide, so group
+# detection keeps more of the resolution
+FACE_GROUP_DETECTION_WIDTH = int(os.getenv("FACE_GROUP_DETECTION_WIDTH", "1600"))
+FACE_CROP_MARGIN = 0.25
+
+class _Stage:
+    """Adds the wall time of a with-block to timings[name] in milliseconds"""
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = (time.perf_counter() - self.start) * 1000.0
+        self.timings[self.name] = self.timings.get(self.name, 0.0) + elapsed
+
+class FaceImage:
+    """One request image, decoded once and shared by detection and encoding
+
+    The RGB array and the face locations (per detection width) are cached
+    on the object, so checking for a face and then encoding it costs a
+    single decode and a single detection. cv2.IMREAD_COLOR applies the EXIF
+    orientation and turns greyscale, RGBA and 16-bit input into 8-bit
+    3-channel pixels while decoding, and the BGR->RGB swap is done in
+    place, so no later stage copies the frame again.
+    """
+
+    def __init__(self, image, timings=None):
+        self.timings = {} if timings is None else timings
+        self.locations = {}
+        self._image = image
+        self._image_data = None
+        self._array = None
+        self._error = None
+
+    @property
+    def image_data(self):
+        if self._image_data is None:
+            with _Stage(self.timings, "decode"):
+                self._image_data = image_bytes(self._image)
+            self._image = None
+        return self._image_data
+
+    @property
+    def array(self):
+        """The RGB uint8 pixels; raises FrameQualityError for frames not worth processing"""
+        if self._error is not None:
+            raise self._error
+        if self._array is None:
+            try:
+                self._array = self._decode()
+            except Exception as e:
+                self._error = e
+                raise
+        return self._array
+
+    def _decode(self):
+        image_data = self.image_data
+        # Cheap thumbnail checks first, so blurry or dark frames never pay
+        # for a full-resolution decode and detection
+        with _Stage(self.timings, "quality"):
+            check_frame_quality(image_data)
+        with _Stage(self.timings, "decode"):
+            # imdecode reads straight from the buffer (no BytesIO/PIL copies)
+            image_array = cv2.imdecode(np.frombuffer(memoryview(image_data), dtype=np.uint8), cv2.IMREAD_COLOR)
+            if image_array is None:
+                raise FrameQualityError("IMAGE_UNREADABLE", "Image could not be decoded, send a JPEG or PNG")
+            return cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB, dst=image_array)
 
 class FaceRecognitionSystem:
     def __init__(self):
-        self.known_face_encodings = []
-        self.known_face_names = []
+        self.gallery = face_gallery
+
+    def load(self, image, timings=None):
+        """Wrap a data URL or raw bytes in a FaceImage (an existing FaceImage is returned as is)"""
+        if isinstance(image, FaceImage):
+            return image
+        return FaceImage(image, timings)
         
-    def encode_face_from_base64(self, base64_image):
-        try:
-            image_data = base64.b64decode(base64_image.split(',')[1])
-            image = Image.open(BytesIO(image_data))
-            image_array = np.array(image)
-            
-            face_locations = face_recognition.face_locations(image_array)
-            if not face_locations:
-                return None
-                
-            face_encodings = face_recognition.face_encodings(image_array, face_locations)
-            if face_encodings:
-                return face_encodings[0].tolist()
+    def _detection_copy(self, image_array, max_width=FACE_DETECTION_WIDTH):
+        height, width = image_array.shape[:2]
+        if max_width <= 0 or width <= max_width:
+            return image_array, 1.0
+        scale = max_width / width
+        size = (max_width, max(int(round(height * scale)), 1))
+        return cv2.resize(image_array, size, interpolation=cv2.INTER_AREA), scale
+
+    def _scale_locations(self, face_locations, scale, shape):
+        if scale == 1.0:
+            return list(face_locations)
+        height, width = shape[:2]
+        return [(
+            max(int(top / scale), 0),
+            min(int(round(right / scale)), width),
+            min(int(round(bottom / scale)), height),
+            max(int(left / scale), 0)
+        ) for top, right, bottom, left in face_locations]
+
+    def _locate_faces(self, face_image, max_width=FACE_DETECTION_WIDTH):
+        face_locations = face_image.locations.get(max_width)
+        if face_locations is not None:
+            return face_locations
+        image_array = face_image.array
+        with _Stage(face_image.timings, "downscale"):
+            small, scale = self._detection_copy(image_array, max_width)
+        with _Stage(face_image.timings, "detect"):
+            face_locations = face_recognition.face_locations(
+                small, number_of_times_to_upsample=FACE_DETECTION_UPSAMPLE, model=FACE_DETECTION_MODEL
+            )
+        face_locations = self._scale_locations(face_locations, scale, image_array.shape)
+        face_image.locations[max_width] = face_locations
+        return face_locations
+
+    def _encode_box(self, image_array, box):
+        # Landmarks and the embedding only need the full-resolution pixels
+        # around the box, not the whole frame
+        top, right, bottom, left = box
+        height, width = image_array.shape[:2]
+        margin = int(FACE_CROP_MARGIN * max(bottom - top, right - left))
+        y0, x0 = max(top - margin, 0), max(left - margin, 0)
+        y1, x1 = min(bottom + margin, height), min(right + margin, width)
+        crop = np.ascontiguousarray(image_array[y0:y1, x0:x1])
+
+        face_encodings = face_recognition.face_encodings(crop, [(top - y0, right - x0, bottom - y0, left - x0)])
+        if face_encodings:
+            return face_encodings[0].tolist()
+        return None
+
+    def _encode_first_face(self, face_image):
+        face_locations = self._locate_faces(face_image)
+        if not face_locations:
             return None
+
+        with _Stage(face_image.timings, "encode"):
+            return self._encode_box(face_image.array, face_locations[0])
+
+    def encode_face_from_base64(self, base64_image, timings=None):
+        return self.encode_face(base64_image, timings)
+
+    def encode_face(self, image, timings=None):
+        """Encoding of the first face in a data URL, raw bytes or FaceImage, or None"""
+        try:
+            return self._encode_first_face(self.load(image, timings))
+        except FrameQualityError:
+            raise
         except Exception as e:
             print(f"Error encoding face: {e}")
             return None
     
-    def compare_faces(self, known_encoding, unknown_encoding, tolerance=0.6):
-        if isinstance(known_encoding, str):
-            known_encoding = json.loads(known_encoding)
-        if isinstance(unknown_encoding, str):
-            unknown_encoding = json.loads(unknown_encoding)
+    def detect_faces(self, image, timings=None, max_width=FACE_DETECTION_WIDTH):
+        """Face boxes in full-resolution coordinates, without encoding anything"""
+        return self._locate_faces(self.load(image, timings), max_width)
+
+    def encode_faces_at(self, image, face_locations, timings=None):
+        """Encode the faces at known boxes, one entry (or None) per box"""
+        face_image = self.load(image, timings)
+        image_array = face_image.array
+        with _Stage(face_image.timings, "encode"):
+            return [self._encode_box(image_array, box) for box in face_locations]
+
+    def detect_and_encode(self, image, skip_boxes=(), iou_threshold=0.3, timings=None, max_width=FACE_DETECTION_WIDTH):
+        """Detect faces and encode the ones not overlapping skip_boxes, from a single decode
+
+        Returns (face_locations, encodings) where encodings maps the index of
+        each encoded location to its encoding (None if encoding failed).
+        """
+        face_image = self.load(image, timings)
+        face_locations = self._locate_faces(face_image, max_width)
+        wanted = [
+            index for index, box in enumerate(face_locations)
+            if all(iou(box, skip) < iou_threshold for skip in skip_boxes)
+        ]
+        encodings = {}
+        if wanted:
+            image_array = face_image.array
+            with _Stage(face_image.timings, "encode"):
+                encodings = {index: self._encode_box(image_array, face_locations[index]) for index in wanted}
+        return face_locations, encodings
+
+    def encode_all_faces(self, image, timings=None):
+        """Detect and encode every face in one image, returning a list of (location, encoding)
+
+        Detection runs once over the frame and all faces go through a
+        single face_encodings call on the full-resolution image.
+        """
+        face_image = self.load(image, timings)
+        face_locations = self._locate_faces(face_image, FACE_GROUP_DETECTION_WIDTH)
+        if not face_locations:
+            return []
+        with _Stage(face_image.timings, "encode"):
+            face_encodings = face_recognition.face_encodings(face_image.array, face_locations)
+        return [(tuple(location), encoding.tolist()) for location, encoding in zip(face_locations, face_encodings)]
+
+    def encode_faces_batch(self, images, timings=None):
+        """Encode several images in one call, a bad image only fails its own slot
+
+        A frame rejected by the quality filter gets its FrameQualityError in
+        place of an encoding.
+        """
+        timings = [{} for _ in images] if timings is None else timings
+        results = [None] * len(images)
+        face_images = {}
+        for index, image in enumerate(images):
+            face_image = self.load(image, timings[index])
+            try:
+                face_image.array
+                face_images[index] = face_image
+            except FrameQualityError as e:
+                results[index] = e
+            except Exception as e:
+                print(f"Error encoding face: {e}")
+
+        # The CNN detector can run same-sized frames through the network as one
+        # batch; HOG has no batched form, so there the gain is one pool task per batch.
+        if FACE_DETECTION_MODEL == "cnn":
+            by_shape = {}
+            for index, face_image in face_images.items():
+                with _Stage(face_image.timings, "downscale"):
+                    small, scale = self._detection_copy(face_image.array)
+                by_shape.setdefault(small.shape, []).append((face_image, small, scale))
+            for group in by_shape.values():
+                started = time.perf_counter()
+                batch = face_recognition.batch_face_locations(
+                    [small for _, small, _ in group],
+                    number_of_times_to_upsample=FACE_DETECTION_UPSAMPLE,
+                    batch_size=len(group)
+                )
+                share = (time.perf_counter() - started) * 1000.0 / len(group)
+                for (face_image, _, scale), face_locations in zip(group, batch):
+                    face_image.timings["detect"] = share
+                    face_image.locations[FACE_DETECTION_WIDTH] = self._scale_locations(face_locations, scale, face_image.array.shape)
+
+        for index, face_image in face_images.items():
+            try:
+                results[index] = self._encode_first_face(face_image)
+            except Exception as e:
+                print(f"Error encoding face: {e}")
+        return results
+    
+    def compare_faces(self, known_encoding, unknown_encoding, tolerance=0.6, templates=None):
+        """Match against a known encoding; with templates, borderline results are re-checked against each one"""
+        if isinstance(known_encoding, (str, bytes, memoryview)):
+            known_encoding = unpack_encoding(known_encoding)
+        if isinstance(unknown_encoding, (str, bytes, memoryview)):
+            unknown_encoding = unpack_encoding(unknown_encoding)
             
-        known_encoding = np.array(known_encoding)
-        unknown_encoding = np.array(unknown_encoding)
+        known_encoding = np.asarray(known_encoding)
+        unknown_encoding = np.asarray(unknown_encoding)
         
         distance = face_recognition.face_distance([known_encoding], unknown_encoding)[0]
+        if templates is not None and len(templates) > 1 and near_boundary(distance, tolerance):
+            distance = min(distance, best_template_distance(templates, unknown_encoding))
         confidence = 1 - distance
         
         return distance <= tolerance, confidence
+
+    def identify_face(self, unknown_encoding, tolerance=0.6, class_id=None, load_templates=None):
+        """Return (user_id, confidence) of the best gallery match, user_id is None when nobody matches
+
+        The gallery holds one centroid per user; when the best centroid lands
+        near the tolerance, load_templates(user_id) supplies that user's
+        individual templates for a closer look.
+        """
+        if isinstance(unknown_encoding, (str, bytes, memoryview)):
+            unknown_encoding = unpack_encoding(unknown_encoding)
+
+        user_id, distance = self.gallery.nearest(unknown_encoding, class_id)
+        if user_id is not None and load_templates is not None and near_boundary(distance, tolerance):
+            templates = load_templates(user_id)
+            if templates is not None and len(templates) > 1:
+                distance = min(distance, best_template_distance(templates, unknown_encoding))
+
+        if user_id is None or distance > tolerance:
+            return None, 1 - distance if distance is not None else 0.0
+        return user_id, 1 - distance
     
-    def detect_face_in_image(self, base64_image):
+    def detect_face_in_image(self, image, timings=None):
+        """Return (found, count); pass a FaceImage to reuse its decode and detection for encode_face"""
         try:
-            image_data = base64.b64decode(base64_image.split(',')[1])
-            image = Image.open(BytesIO(image_data))
-            image_array = np.array(image)
-            
-            face_locations = face_recognition.face_locations(image_array)
+            face_locations = self._locate_faces(self.load(image, timings))
             return len(face_locations) > 0, len(face_locations)
+        except FrameQualityError:
+            return False, 0
         except Exception as e:
             print(f"Error detecting face: {e}")
             return False, 0
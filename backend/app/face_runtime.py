@@ -0,0 +1,110 @@
+import asyncio
+import importlib
+import os
+import threading
+import time
+
+from .database import SessionLocal
+from .face_gallery import face_gallery
+from .face_workers import face_pool
+
+# background: the API serves at once and the face stack loads in a thread
+# eager: startup blocks until the face stack is ready (the old behaviour)
+# lazy: nothing loads until the first face request asks for it
+FACE_WARMUP = os.getenv("FACE_WARMUP", "background")
+FACE_WARMUP_RETRY_AFTER = int(os.getenv("FACE_WARMUP_RETRY_AFTER", "5"))
+
+class FaceStackNotReady(Exception):
+    pass
+
+class FaceRuntime:
+    """Loads cv2/dlib, the face gallery and the worker pool off the startup path
+
+    Importing face_recognition pulls in the dlib models, and the gallery
+    may need a full table scan plus an index build, so none of it happens
+    at module import. Readiness is tracked separately from liveness.
+    """
+
+    def __init__(self, mode=FACE_WARMUP):
+        self.mode = mode
+        self.state = "cold"
+        self.error = None
+        self.timings = {}
+        self._task = None
+        self._system = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    def system(self):
+        """The FaceRecognitionSystem, importing the face stack on first use"""
+        if self._system is None:
+            with self._lock:
+                if self._system is None:
+                    started = time.perf_counter()
+                    module = importlib.import_module(".face_recognition_utils", __package__)
+                    self.timings["import_ms"] = round((time.perf_counter() - started) * 1000.0, 1)
+                    self._system = module.face_system
+        return self._system
+
+    def _load_gallery(self):
+        started = time.perf_counter()
+        db = SessionLocal()
+        try:
+            count = face_gallery.load(db)
+        finally:
+            db.close()
+        self.timings["gallery_ms"] = round((time.perf_counter() - started) * 1000.0, 1)
+        return count
+
+    async def _warm_up(self):
+        started = time.perf_counter()
+        self.state = "loading"
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.system)
+            count = await loop.run_in_executor(None, self._load_gallery)
+
+            pool_started = time.perf_counter()
+            face_pool.start()
+            await face_pool.warm_up()
+            self.timings["workers_ms"] = round((time.perf_counter() - pool_started) * 1000.0, 1)
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+            print(f"Face stack failed to load: {e}")
+            return
+        self.timings["total_ms"] = round((time.perf_counter() - started) * 1000.0, 1)
+        self.state = "ready"
+        print(f"Face stack ready: {count} encodings, {self.timings}")
+
+    def start(self):
+        """Begin loading in the background; safe to call more than once"""
+        if self._task is None or self.state == "failed":
+            self.error = None
+            self._task = asyncio.ensure_future(self._warm_up())
+        return self._task
+
+    async def startup(self):
+        if self.mode == "eager":
+            await self.start()
+        elif self.mode != "lazy":
+            self.start()
+
+    def require_ready(self):
+        if self.ready:
+            return
+        self.start()
+        raise FaceStackNotReady()
+
+    def status(self):
+        return {
+            "state": self.state,
+            "mode": self.mode,
+            "timings": dict(self.timings),
+            "error": self.error
+        }
+
+face_runtime = FaceRuntime()
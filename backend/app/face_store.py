@@ -0,0 +1,313 @@
+import glob
+import mmap
+import os
+import re
+import threading
+import time
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+STORE_MAGIC = b"FGAL"
+STORE_VERSION = 3
+HEADER_BYTES = 128
+MIN_CAPACITY = 1024
+# A write still in progress after this long is assumed to be from a dead process
+STALE_WRITE_SECONDS = 2.0
+
+# Header: magic, version, dim, padding, then eight little-endian uint64 words
+GENERATION, COUNT, CAPACITY, FLAGS, NEXT_EPOCH, ROSTER_GENERATION, DATABASE_ID, FACE_STAMP = range(8)
+META_OFFSET = 16
+META_WORDS = 8
+
+# FLAGS bits
+INITIALIZED = 1  # a full load has been published at least once
+SUPERSEDED = 2   # grown into the file for NEXT_EPOCH, reopen that one
+
+class _FileLock:
+    """Exclusive lock shared by every process using the same store directory"""
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            else:
+                while True:
+                    try:
+                        msvcrt.locking(self._fd, msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        time.sleep(0.01)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+            os.close(self._fd)
+            self._fd = None
+        self._thread_lock.release()
+
+class _NullLock:
+    def __init__(self):
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+class SharedEncodingStore:
+    """Encoding matrix in a memory-mapped file that every worker process maps
+
+    The OS page cache holds one copy of the matrix no matter how many
+    uvicorn workers read it. Writers are serialised by a lock file and
+    publish with a seqlock: the generation word is odd while rows are being
+    changed and even once they are consistent, so readers retry a search
+    that overlapped a write instead of taking a lock. When the file is
+    full a writer copies it into a file twice the size for the next epoch
+    and flags the old one, and readers follow the flag.
+
+    Without a directory the same layout lives in an anonymous buffer,
+    private to the process.
+    """
+
+    def __init__(self, dim=128, directory=None):
+        self.dim = dim
+        self.directory = directory
+        self.epoch = None
+        self._buffer = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.lock = _FileLock(os.path.join(directory, f"gallery.v{STORE_VERSION}.lock"))
+        else:
+            self.lock = _NullLock()
+        with self.lock:
+            self._open_latest()
+
+    # Layout
+
+    def _path(self, epoch):
+        return os.path.join(self.directory, f"gallery.v{STORE_VERSION}.{epoch}.bin")
+
+    def _size(self, capacity):
+        return HEADER_BYTES + capacity * (8 + 4 * self.dim + 4)
+
+    def _map(self, buffer, epoch):
+        header = np.frombuffer(buffer, dtype="<u4", count=3, offset=4)
+        if bytes(buffer[:4]) != STORE_MAGIC or header[0] != STORE_VERSION or header[1] != self.dim:
+            raise ValueError("Not a face gallery store for this encoding size")
+        self._meta = np.frombuffer(buffer, dtype="<u8", count=META_WORDS, offset=META_OFFSET)
+        capacity = int(self._meta[CAPACITY])
+        offset = HEADER_BYTES
+        self.user_ids = np.frombuffer(buffer, dtype="<i8", count=capacity, offset=offset)
+        offset += 8 * capacity
+        self.encodings = np.frombuffer(buffer, dtype="<f4", count=capacity * self.dim, offset=offset).reshape(capacity, self.dim)
+        offset += 4 * capacity * self.dim
+        self.sq_norms = np.frombuffer(buffer, dtype="<f4", count=capacity, offset=offset)
+        self._buffer = buffer
+        self.epoch = epoch
+
+    def _create(self, epoch, capacity):
+        header = bytearray(HEADER_BYTES)
+        header[:4] = STORE_MAGIC
+        np.frombuffer(header, dtype="<u4", count=3, offset=4)[:] = (STORE_VERSION, self.dim, 0)
+        np.frombuffer(header, dtype="<u8", count=META_WORDS, offset=META_OFFSET)[CAPACITY] = capacity
+
+        size = self._size(capacity)
+        if not self.directory:
+            buffer = bytearray(size)
+            buffer[:HEADER_BYTES] = header
+            return buffer
+
+        # The header is written before the rename so no process can map a
+        # file without it
+        path = self._path(epoch)
+        with open(path + ".tmp", "wb") as f:
+            f.write(header)
+            f.truncate(size)
+        os.replace(path + ".tmp", path)
+        return self._mmap(path)
+
+    def _mmap(self, path):
+        with open(path, "r+b") as f:
+            return mmap.mmap(f.fileno(), 0)
+
+    def _epochs(self):
+        pattern = re.compile(rf"gallery\.v{STORE_VERSION}\.(\d+)\.bin$")
+        epochs = []
+        for path in glob.glob(os.path.join(self.directory, f"gallery.v{STORE_VERSION}.*.bin")):
+            match = pattern.search(path)
+            if match:
+                epochs.append(int(match.group(1)))
+        return sorted(epochs)
+
+    def _open_latest(self):
+        # Caller holds the write lock
+        epochs = self._epochs() if self.directory else []
+        for epoch in reversed(epochs):
+            try:
+                self._map(self._mmap(self._path(epoch)), epoch)
+            except (OSError, ValueError):
+                continue
+            self._remove_old_epochs(epoch)
+            return
+        self._map(self._create(0, MIN_CAPACITY), 0)
+
+    def _remove_old_epochs(self, current):
+        for epoch in self._epochs():
+            if epoch < current:
+                try:
+                    os.remove(self._path(epoch))
+                except OSError:
+                    # Still mapped by another process on Windows; a later open retries
+                    pass
+
+    # Readers
+
+    def refresh(self):
+        """Follow the store into a newer file if another process grew it; True if it moved"""
+        moved = False
+        while int(self._meta[FLAGS]) & SUPERSEDED:
+            next_epoch = int(self._meta[NEXT_EPOCH])
+            try:
+                self._map(self._mmap(self._path(next_epoch)), next_epoch)
+            except OSError:
+                # Grown more than once since we last looked and the
+                # intermediate file is gone; jump to the newest one
+                latest = self._epochs()[-1]
+                self._map(self._mmap(self._path(latest)), latest)
+            moved = True
+        return moved
+
+    @property
+    def generation(self):
+        return int(self._meta[GENERATION])
+
+    @property
+    def count(self):
+        return int(self._meta[COUNT])
+
+    @property
+    def capacity(self):
+        return int(self._meta[CAPACITY])
+
+    @property
+    def initialized(self):
+        return bool(int(self._meta[FLAGS]) & INITIALIZED)
+
+    @property
+    def roster_generation(self):
+        return int(self._meta[ROSTER_GENERATION])
+
+    @property
+    def database_id(self):
+        """Identifies the database the rows were loaded from (0 if never loaded)"""
+        return int(self._meta[DATABASE_ID])
+
+    @property
+    def face_stamp(self):
+        """Newest face_updated_at (in microseconds) of the rows written so far"""
+        return int(self._meta[FACE_STAMP])
+
+    def read(self, fn):
+        """Run fn(count) against a consistent view, retrying if a write overlapped it"""
+        waiting_since = None
+        while True:
+            self.refresh()
+            start = self.generation
+            if start & 1:
+                waiting_since = waiting_since or time.monotonic()
+                if time.monotonic() - waiting_since > STALE_WRITE_SECONDS:
+                    self._recover()
+                time.sleep(0)
+                continue
+            result = fn(self.count)
+            if self.generation == start and not int(self._meta[FLAGS]) & SUPERSEDED:
+                return result
+
+    def _recover(self):
+        # Writers hold the lock for the whole write, so an odd generation
+        # seen while holding it means the writer died mid-write
+        with self.lock:
+            self.refresh()
+            if self.generation & 1:
+                print("Face gallery store: recovering from an interrupted write")
+                self._meta[GENERATION] += 1
+
+    # Writers (call inside `with store.lock` and between begin_write/end_write)
+
+    def begin_write(self):
+        self.refresh()
+        if self.generation & 1:
+            # Left odd by a writer that died; we hold the lock, so finish it off
+            self._meta[GENERATION] += 1
+        self._meta[GENERATION] += 1
+
+    def end_write(self, count, initialized=False, database_id=None, face_stamp=None):
+        self._meta[COUNT] = count
+        if database_id is not None:
+            self._meta[DATABASE_ID] = database_id
+        if face_stamp is not None:
+            self._meta[FACE_STAMP] = face_stamp
+        if initialized:
+            self._meta[FLAGS] |= INITIALIZED
+        self._meta[GENERATION] += 1
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.flush()
+
+    def bump_rosters(self):
+        """Tell other processes a class roster changed; returns the (before, after) roster generation"""
+        with self.lock:
+            self.refresh()
+            before = int(self._meta[ROSTER_GENERATION])
+            self._meta[ROSTER_GENERATION] = before + 1
+            return before, before + 1
+
+    def reserve(self, capacity):
+        """Make room for capacity rows, moving to a larger file if needed"""
+        if capacity <= self.capacity:
+            return
+        new_capacity = max(capacity, 2 * self.capacity, MIN_CAPACITY)
+        count = self.count
+        old_meta = self._meta
+        buffer = self._create(self.epoch + 1, new_capacity)
+        meta = np.frombuffer(buffer, dtype="<u8", count=META_WORDS, offset=META_OFFSET)
+        # Starts odd: the caller is in the middle of a write
+        meta[GENERATION] = old_meta[GENERATION]
+        meta[COUNT] = count
+        meta[FLAGS] = old_meta[FLAGS]
+        meta[ROSTER_GENERATION] = old_meta[ROSTER_GENERATION]
+        meta[DATABASE_ID] = old_meta[DATABASE_ID]
+        meta[FACE_STAMP] = old_meta[FACE_STAMP]
+        old_epoch = self.epoch
+        old_ids, old_encodings, old_norms = self.user_ids, self.encodings, self.sq_norms
+
+        self._map(buffer, old_epoch + 1)
+        self.user_ids[:count] = old_ids[:count]
+        self.encodings[:count] = old_encodings[:count]
+        self.sq_norms[:count] = old_norms[:count]
+
+        old_meta[NEXT_EPOCH] = old_epoch + 1
+        old_meta[FLAGS] |= SUPERSEDED
+        if self.directory:
+            self._remove_old_epochs(old_epoch + 1)
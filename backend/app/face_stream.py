@@ -0,0 +1,143 @@
+import asyncio
+import os
+
+from .encoding_cache import image_bytes
+from .face_tracking import FaceTracker
+from .face_workers import face_pool, FacePoolSaturated
+from .frame_quality import FrameQualityError
+
+# At 15 fps, detecting on every other frame leaves ~130 ms per detection
+# on one core; tracks carry identities across the skipped frames
+FACE_STREAM_DETECT_EVERY = int(os.getenv("FACE_STREAM_DETECT_EVERY", "2"))
+FACE_STREAM_DETECTION_WIDTH = int(os.getenv("FACE_STREAM_DETECTION_WIDTH", "480"))
+
+class FaceStreamSession:
+    """Turns one camera's frame stream into attendance events for a class
+
+    Frames arrive faster than they can be processed, so only the newest
+    one is kept and stale frames are dropped. Every detect_every-th frame
+    goes through detection and tracking; face encodings only run for
+    tracks that have not been recognised yet, in the same worker task
+    (and from the same decode) as the detection.
+    """
+
+    def __init__(self, class_id, identify, on_recognized, send, detect_every=FACE_STREAM_DETECT_EVERY, detection_width=FACE_STREAM_DETECTION_WIDTH):
+        self.class_id = class_id
+        self.identify = identify
+        self.on_recognized = on_recognized
+        self.send = send
+        self.detect_every = max(detect_every, 1)
+        self.detection_width = detection_width
+        self.tracker = FaceTracker()
+        self.frames_received = 0
+        self.frames_skipped = 0
+        self.frames_dropped = 0
+        self.frames_rejected = 0
+        self.frames_processed = 0
+        self.encodings = 0
+        self._latest = None
+        self._ready = asyncio.Event()
+        self._closed = False
+        self._recognized = set()
+        self._tasks = set()
+
+    def push(self, frame):
+        self.frames_received += 1
+        if self.frames_received % self.detect_every:
+            self.frames_skipped += 1
+            return
+        if self._latest is not None:
+            self.frames_dropped += 1
+        self._latest = frame
+        self._ready.set()
+
+    def close(self):
+        self._closed = True
+        self._ready.set()
+
+    async def run(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            if self._closed:
+                break
+            frame, self._latest = self._latest, None
+            if frame is None:
+                continue
+            try:
+                await self.process(frame)
+            except Exception as e:
+                # One bad frame must not end the session
+                self.frames_rejected += 1
+                print(f"Attendance stream frame failed: {e!r}")
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def process(self, frame):
+        # Faces on settled tracks keep their identity, so the worker skips encoding them
+        skip_boxes = [track.box for track in self.tracker.tracks if track.settled()]
+        try:
+            image_data = image_bytes(frame)
+            face_locations, encodings = await face_pool.detect_and_encode(
+                image_data, self.detection_width, skip_boxes, self.tracker.iou_threshold
+            )
+        except (FrameQualityError, FacePoolSaturated, ValueError, IndexError):
+            self.frames_rejected += 1
+            return
+        self.frames_processed += 1
+        self.encodings += len(encodings)
+
+        boxes = [tuple(box) for box in face_locations]
+        new_tracks = self.tracker.update(boxes)
+        if new_tracks:
+            encoded = {boxes[index]: encoding for index, encoding in encodings.items()}
+            await self._recognize(image_data, new_tracks, encoded)
+
+        await self.send({
+            "event": "faces",
+            "frame": self.frames_received,
+            "faces": [
+                {"track_id": track.id, "box": track.box, "user_id": track.user_id}
+                for track in self.tracker.tracks if track.misses == 0
+            ]
+        })
+
+    async def _recognize(self, image_data, tracks, encoded):
+        for track in tracks:
+            track.attempts += 1
+            track.last_attempt = track.age
+        missing = [track for track in tracks if track.box not in encoded]
+        if missing:
+            # The worker skipped a face the tracker then gave a new track
+            # (overlapping faces); only then is the frame encoded a second time
+            try:
+                encodings = await face_pool.encode_faces_at(image_data, [track.box for track in missing])
+            except (FrameQualityError, FacePoolSaturated):
+                return
+            self.encodings += len(missing)
+            encoded.update(zip((track.box for track in missing), encodings))
+
+        # Roster reloads and template reads hit the database, so identify() runs off the loop
+        results = await self.identify([encoded[track.box] for track in tracks])
+        for track, (user_id, confidence) in zip(tracks, results):
+            if user_id is None:
+                continue
+            track.user_id = user_id
+            track.confidence = confidence
+            if user_id not in self._recognized:
+                # Attendance is written in the background so the next frame is not held up
+                self._recognized.add(user_id)
+                task = asyncio.ensure_future(self.on_recognized(user_id, confidence))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    def stats(self):
+        return {
+            "frames_received": self.frames_received,
+            "frames_skipped": self.frames_skipped,
+            "frames_dropped": self.frames_dropped,
+            "frames_rejected": self.frames_rejected,
+            "frames_processed": self.frames_processed,
+            "encodings": self.encodings,
+            "recognized": len(self._recognized)
+        }
@@ -0,0 +1,50 @@
+import os
+import numpy as np
+
+FACE_MAX_TEMPLATES = int(os.getenv("FACE_MAX_TEMPLATES", "5"))
+# A template further than this from the centroid of the others is treated
+# as a bad capture (wrong person, heavy blur, odd pose) and dropped
+FACE_TEMPLATE_MAX_SPREAD = float(os.getenv("FACE_TEMPLATE_MAX_SPREAD", "0.45"))
+# Matches whose centroid distance lands within this band around the
+# tolerance are re-checked against every template
+FACE_TEMPLATE_MARGIN = float(os.getenv("FACE_TEMPLATE_MARGIN", "0.08"))
+
+def centroid(templates):
+    return np.asarray(templates, dtype=np.float32).mean(axis=0)
+
+def prune_templates(templates, max_templates=FACE_MAX_TEMPLATES, max_spread=FACE_TEMPLATE_MAX_SPREAD):
+    """Drop outliers and trim to max_templates, returning (templates, pruned count)
+
+    Repeatedly removes the template furthest from the centroid of the
+    remaining ones while it is beyond max_spread or the set is over
+    capacity. Outliers are only judged with at least three templates,
+    since with two there is no telling which one is wrong.
+    """
+    templates = np.asarray(templates, dtype=np.float32)
+    pruned = 0
+    while len(templates) > 1:
+        # Leave-one-out distances, so an outlier cannot pull the centroid toward itself
+        others = (templates.sum(axis=0) - templates) / (len(templates) - 1)
+        distances = np.linalg.norm(templates - others, axis=1)
+        worst = int(np.argmax(distances))
+        over_capacity = len(templates) > max_templates
+        outlier = len(templates) >= 3 and distances[worst] > max_spread
+        if not (over_capacity or outlier):
+            break
+        templates = np.delete(templates, worst, axis=0)
+        pruned += 1
+    return templates, pruned
+
+def add_template(templates, encoding):
+    """Append a new encoding to an existing (k, dim) stack (or None) and prune"""
+    encoding = np.asarray(encoding, dtype=np.float32).reshape(1, -1)
+    if templates is None or len(templates) == 0:
+        return encoding, 0
+    return prune_templates(np.vstack([templates, encoding]))
+
+def near_boundary(distance, tolerance, margin=FACE_TEMPLATE_MARGIN):
+    return distance is not None and abs(distance - tolerance) <= margin
+
+def best_template_distance(templates, probe):
+    probe = np.asarray(probe, dtype=np.float32).ravel()
+    return float(np.linalg.norm(np.asarray(templates, dtype=np.float32) - probe, axis=1).min())
@@ -0,0 +1,86 @@
+import os
+
+FACE_TRACK_IOU = float(os.getenv("FACE_TRACK_IOU", "0.3"))
+# Detection passes a track may go unseen before it is dropped
+FACE_TRACK_MAX_MISSES = int(os.getenv("FACE_TRACK_MAX_MISSES", "5"))
+# An unrecognised track is re-encoded after this many detection passes,
+# in case the first look was a profile or motion-blurred face
+FACE_TRACK_RETRY_AFTER = int(os.getenv("FACE_TRACK_RETRY_AFTER", "10"))
+FACE_TRACK_MAX_ATTEMPTS = int(os.getenv("FACE_TRACK_MAX_ATTEMPTS", "3"))
+
+def iou(a, b):
+    """Intersection over union of two (top, right, bottom, left) boxes"""
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    intersection = max(bottom - top, 0) * max(right - left, 0)
+    if intersection == 0:
+        return 0.0
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    return intersection / float(area_a + area_b - intersection)
+
+class Track:
+    def __init__(self, track_id, box):
+        self.id = track_id
+        self.box = box
+        self.misses = 0
+        self.age = 0
+        self.attempts = 0
+        self.last_attempt = 0
+        self.user_id = None
+        self.confidence = None
+
+    def needs_encoding(self):
+        if self.user_id is not None or self.attempts >= FACE_TRACK_MAX_ATTEMPTS:
+            return False
+        return self.attempts == 0 or self.age - self.last_attempt >= FACE_TRACK_RETRY_AFTER
+
+    def settled(self):
+        """True if the next detection pass will not ask for this track to be encoded"""
+        if self.user_id is not None or self.attempts >= FACE_TRACK_MAX_ATTEMPTS:
+            return True
+        return self.attempts > 0 and self.age + 1 - self.last_attempt < FACE_TRACK_RETRY_AFTER
+
+class FaceTracker:
+    """Greedy IoU tracker that keeps a face's identity across frames
+
+    A face only needs encoding when a track is first seen (or when an
+    earlier attempt failed to recognise it); every other frame is just a
+    detection plus box matching.
+    """
+
+    def __init__(self, iou_threshold=FACE_TRACK_IOU, max_misses=FACE_TRACK_MAX_MISSES):
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.tracks = []
+        self._next_id = 1
+
+    def update(self, boxes):
+        """Match this frame's boxes to existing tracks and return the tracks that need encoding"""
+        pairs = sorted(
+            ((iou(track.box, box), t, b) for t, track in enumerate(self.tracks) for b, box in enumerate(boxes)),
+            reverse=True
+        )
+        matched_tracks, matched_boxes = set(), set()
+        for overlap, t, b in pairs:
+            if overlap < self.iou_threshold:
+                break
+            if t in matched_tracks or b in matched_boxes:
+                continue
+            matched_tracks.add(t)
+            matched_boxes.add(b)
+            self.tracks[t].box = boxes[b]
+            self.tracks[t].misses = 0
+
+        for t, track in enumerate(self.tracks):
+            track.age += 1
+            if t not in matched_tracks:
+                track.misses += 1
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+
+        for b, box in enumerate(boxes):
+            if b not in matched_boxes:
+                self.tracks.append(Track(self._next_id, tuple(box)))
+                self._next_id += 1
+
+        return [track for track in self.tracks if track.misses == 0 and track.needs_encoding()]
@@ -0,0 +1,248 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .metrics import StageStats
+
+# 0 workers runs the pipeline on the default thread pool instead of
+# separate processes, which is handy for development on small machines.
+FACE_POOL_WORKERS = int(os.getenv("FACE_POOL_WORKERS", os.cpu_count() or 1))
+FACE_POOL_MAX_PENDING = int(os.getenv("FACE_POOL_MAX_PENDING", max(FACE_POOL_WORKERS, 1) * 4))
+FACE_POOL_RETRY_AFTER = int(os.getenv("FACE_POOL_RETRY_AFTER", "2"))
+
+# Latency/throughput knob: how long the first probe of a batch may wait for
+# company, and the batch size that flushes immediately. A 0 ms window
+# disables coalescing. A batch is one pool task, so its images run one
+# after another on a single worker while the others may sit idle. That
+# only pays off with the cnn detector, which locates faces in same-sized
+# frames in one batched pass; with hog it just adds queueing, so the
+# window defaults to 0 there.
+FACE_DETECTION_MODEL = os.getenv("FACE_DETECTION_MODEL", "hog")
+FACE_BATCH_WINDOW_MS = float(os.getenv("FACE_BATCH_WINDOW_MS", "10" if FACE_DETECTION_MODEL == "cnn" else "0"))
+FACE_BATCH_MAX_SIZE = int(os.getenv("FACE_BATCH_MAX_SIZE", "8"))
+
+class FacePoolSaturated(Exception):
+    pass
+
+def _warm_up():
+    # Pay the face_recognition/dlib import once per worker, not per request
+    from . import face_recognition_utils
+
+def _ping():
+    return os.getpid()
+
+def _encode_face(image):
+    from .face_recognition_utils import face_system
+    timings = {}
+    return face_system.encode_face(image, timings), timings
+
+def _encode_all_faces(image):
+    from .face_recognition_utils import face_system
+    timings = {}
+    return face_system.encode_all_faces(image, timings), timings
+
+def _detect_and_encode(image, max_width, skip_boxes, iou_threshold):
+    from .face_recognition_utils import face_system
+    timings = {}
+    return face_system.detect_and_encode(image, skip_boxes, iou_threshold, timings, max_width), timings
+
+def _encode_faces_at(image, face_locations):
+    from .face_recognition_utils import face_system
+    timings = {}
+    return face_system.encode_faces_at(image, face_locations, timings), timings
+
+def _encode_faces_batch(images):
+    from .face_recognition_utils import face_system
+    timings = [{} for _ in images]
+    return list(zip(face_system.encode_faces_batch(images, timings), timings))
+
+class FaceEncodingPool:
+    """Runs the decode/detect/encode pipeline off the event loop with a bounded queue"""
+
+    def __init__(self, max_workers=FACE_POOL_WORKERS, max_pending=FACE_POOL_MAX_PENDING):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.restarts = 0
+        self.stage_stats = StageStats()
+        self._executor = None
+        self._restart_lock = threading.Lock()
+
+    def start(self):
+        if self._executor is None and self.max_workers > 0:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=_warm_up)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _restart(self, broken):
+        with self._restart_lock:
+            # Every task in flight fails together when a worker dies; only the
+            # first replaces the pool, the rest must not cancel the new one
+            if self._executor is not broken:
+                return
+            self.shutdown()
+            self.start()
+            self.restarts += 1
+
+    async def warm_up(self):
+        """Spawn every worker (running the _warm_up initializer) now instead of on the first request"""
+        if self._executor is None:
+            return
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self._executor, _ping) for _ in range(self.max_workers)))
+
+    async def run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise FacePoolSaturated()
+
+        self.pending += 1
+        executor = self._executor
+        ok = False
+        try:
+            loop = asyncio.get_running_loop()
+            try:
+                future = loop.run_in_executor(executor, fn, *args)
+            except RuntimeError:
+                # Shut down by a concurrent restart before the submit; hand
+                # the task to the replacement, if there is one
+                if self._executor is None or self._executor is executor:
+                    raise FacePoolSaturated()
+                executor = self._executor
+                future = loop.run_in_executor(executor, fn, *args)
+            result = await future
+            ok = True
+            return result
+        except BrokenProcessPool:
+            # A worker died (e.g. out of memory); replace the pool and let the client retry
+            self._restart(executor)
+            raise FacePoolSaturated()
+        finally:
+            self.pending -= 1
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    async def encode_face(self, image):
+        """Encode a base64 data URL or raw image bytes in a worker"""
+        started = time.perf_counter()
+        encoding, timings = await self.run(_encode_face, image)
+        timings["total"] = (time.perf_counter() - started) * 1000.0
+        self.stage_stats.record(timings)
+        return encoding
+
+    async def encode_all_faces(self, image):
+        """Encode every face in a group photo in a worker"""
+        started = time.perf_counter()
+        faces, timings = await self.run(_encode_all_faces, image)
+        timings["total"] = (time.perf_counter() - started) * 1000.0
+        self.stage_stats.record(timings)
+        return faces
+
+    async def detect_and_encode(self, image, max_width, skip_boxes, iou_threshold):
+        """Locate faces and encode those not covered by skip_boxes in one worker task"""
+        started = time.perf_counter()
+        result, timings = await self.run(_detect_and_encode, image, max_width, skip_boxes, iou_threshold)
+        timings["total"] = (time.perf_counter() - started) * 1000.0
+        self.stage_stats.record(timings)
+        return result
+
+    async def encode_faces_at(self, image, face_locations):
+        """Encode the faces at the given boxes in a worker"""
+        started = time.perf_counter()
+        encodings, timings = await self.run(_encode_faces_at, image, face_locations)
+        timings["total"] = (time.perf_counter() - started) * 1000.0
+        self.stage_stats.record(timings)
+        return encodings
+
+    def stats(self):
+        return {
+            "workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "restarts": self.restarts
+        }
+
+class FaceEncodingBatcher:
+    """Coalesces probes arriving within a short window into one pool task"""
+
+    def __init__(self, pool, window_ms=FACE_BATCH_WINDOW_MS, max_size=FACE_BATCH_MAX_SIZE):
+        self.pool = pool
+        self.window = window_ms / 1000.0
+        self.max_size = max(max_size, 1)
+        self.batches = 0
+        self.images = 0
+        self._queue = []
+        self._timer = None
+        self._tasks = set()
+
+    async def encode_face(self, image):
+        if self.window <= 0 or self.max_size == 1:
+            return await self.pool.encode_face(image)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.append((image, future))
+
+        if len(self._queue) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._queue = self._queue, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        self.batches += 1
+        self.images += len(batch)
+        started = time.perf_counter()
+        try:
+            results = await self.pool.run(_encode_faces_batch, [image for image, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        total = (time.perf_counter() - started) * 1000.0
+        for (_, future), (encoding, timings) in zip(batch, results):
+            timings["total"] = total
+            self.pool.stage_stats.record(timings)
+            if future.done():
+                continue
+            if isinstance(encoding, Exception):
+                future.set_exception(encoding)
+            else:
+                future.set_result(encoding)
+
+    def stats(self):
+        return {
+            "window_ms": self.window * 1000.0,
+            "max_size": self.max_size,
+            "batches": self.batches,
+            "images": self.images,
+            "mean_batch_size": self.images / self.batches if self.batches else 0.0
+        }
+
+face_pool = FaceEncodingPool()
+face_batcher = FaceEncodingBatcher(face_pool)
@@ -0,0 +1,71 @@
+import os
+from collections import Counter
+from io import BytesIO
+import numpy as np
+
+FACE_MIN_IMAGE_SIZE = int(os.getenv("FACE_MIN_IMAGE_SIZE", "160"))
+FACE_MIN_SHARPNESS = float(os.getenv("FACE_MIN_SHARPNESS", "30"))
+FACE_MIN_BRIGHTNESS = float(os.getenv("FACE_MIN_BRIGHTNESS", "40"))
+FACE_MAX_BRIGHTNESS = float(os.getenv("FACE_MAX_BRIGHTNESS", "220"))
+FACE_MAX_CLIPPED_FRACTION = float(os.getenv("FACE_MAX_CLIPPED_FRACTION", "0.5"))
+QUALITY_THUMBNAIL_WIDTH = 320
+
+# Rejections seen by this process, keyed by error code
+quality_rejections = Counter()
+
+class FrameQualityError(Exception):
+    # The same bytes always fail the same way, so the result may be cached
+    cacheable = True
+
+    def __init__(self, code, message):
+        super().__init__(code, message)
+        self.code = code
+        self.message = message
+
+# cv2 and PIL are imported inside the checks: the API process only needs
+# FrameQualityError at import time and the imaging stack loads with the
+# rest of the face pipeline
+
+def _thumbnail(image_data):
+    import cv2
+    from PIL import Image
+
+    image = Image.open(BytesIO(image_data))
+    # For JPEG, draft() makes the decoder scale down by 1/2..1/8 in the DCT
+    # domain, so the thumbnail costs a fraction of a full decode.
+    image.draft("L", (QUALITY_THUMBNAIL_WIDTH, QUALITY_THUMBNAIL_WIDTH))
+    gray = np.asarray(image.convert("L"))
+    height, width = gray.shape
+    if width > QUALITY_THUMBNAIL_WIDTH:
+        size = (QUALITY_THUMBNAIL_WIDTH, max(int(round(height * QUALITY_THUMBNAIL_WIDTH / width)), 1))
+        gray = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+    return gray
+
+def check_frame_quality(image_data):
+    """Raise FrameQualityError for frames not worth running face detection on"""
+    import cv2
+    from PIL import Image
+
+    try:
+        width, height = Image.open(BytesIO(image_data)).size
+        if min(width, height) < FACE_MIN_IMAGE_SIZE:
+            raise FrameQualityError("FRAME_TOO_SMALL", f"Image must be at least {FACE_MIN_IMAGE_SIZE}px on each side")
+        gray = _thumbnail(image_data)
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError):
+        # Truncated, empty or non-image bytes: the client sent something undecodable
+        raise FrameQualityError("IMAGE_UNREADABLE", "Image could not be decoded, send a JPEG or PNG")
+
+    histogram = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+    total = histogram.sum()
+    brightness = float(histogram @ np.arange(256)) / total
+    if brightness < FACE_MIN_BRIGHTNESS:
+        raise FrameQualityError("FRAME_TOO_DARK", "Image is too dark, move to a brighter spot")
+    if brightness > FACE_MAX_BRIGHTNESS:
+        raise FrameQualityError("FRAME_TOO_BRIGHT", "Image is overexposed, avoid direct light")
+    clipped = (histogram[:8].sum() + histogram[248:].sum()) / total
+    if clipped > FACE_MAX_CLIPPED_FRACTION:
+        raise FrameQualityError("FRAME_LOW_CONTRAST", "Too much of the image is over- or underexposed")
+
+    sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    if sharpness < FACE_MIN_SHARPNESS:
+        raise FrameQualityError("FRAME_TOO_BLURRY", "Image is too blurry, hold the camera steady")
@@ -1,16 +1,30 @@
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form, WebSocket
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, undefer_group
 from datetime import datetime, timedelta
 from typing import List, Optional
 from pydantic import BaseModel
-import json
+import asyncio
 import math
+import os
+import time
 
-from .database import get_db, User, Class, Attendance, Enrollment
-from .auth import authenticate_user, create_access_token, get_current_active_user, get_password_hash, ACCESS_TOKEN_EXPIRE_MINUTES
-from .face_recognition_utils import face_system
+IMPORT_STARTED = time.perf_counter()
+
+from .database import get_db, run_db, database_settings, SessionLocal, User, Class, Attendance, Enrollment
+from .auth import authenticate_user, create_user_tokens, refresh_user_tokens, token_revocations, get_current_user, get_current_active_user, hash_password, password_hasher
+from .face_gallery import face_gallery
+from .face_runtime import face_runtime, FaceStackNotReady, FACE_WARMUP_RETRY_AFTER
+from .face_encoding_codec import pack_encoding, stored_encoding, pack_templates, unpack_templates, stored_templates
+from .face_templates import add_template, centroid
+from .face_workers import face_pool, face_batcher, FacePoolSaturated, FACE_POOL_RETRY_AFTER
+from .frame_quality import FrameQualityError, quality_rejections
+from .encoding_cache import encoding_cache, image_bytes
+from .face_stream import FaceStreamSession
+
+FACE_MAX_UPLOAD_BYTES = int(os.getenv("FACE_MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
 
 app = FastAPI(title="Smart Attendance System", version="1.0.0")
 
@@ -54,10 +68,18 @@ class AttendanceCreate(BaseModel):
     longitude: Optional[float] = None
     face_image: Optional[str] = None
 
+class IdentifyRequest(BaseModel):
+    class_id: int
+    face_image: str
+
 class Token(BaseModel):
     access_token: str
     token_type: str
     user: UserResponse
+    refresh_token: Optional[str] = None
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 def calculate_distance(lat1, lon1, lat2, lon2):
     R = 6371000  # Earth's radius in meters
@@ -71,13 +93,124 @@ def calculate_distance(lat1, lon1, lat2, lon2):
     
     return R * c
 
+@app.on_event("startup")
+def report_database_settings():
+    print(f"Database: {database_settings()}")
+
+@app.on_event("startup")
+async def warm_up_face_stack():
+    # cv2/dlib, the gallery and the worker pool load in the background so
+    # /health, /token and the class endpoints answer straight away
+    await face_runtime.startup()
+    print(f"API startup took {(time.perf_counter() - IMPORT_STARTED) * 1000.0:.0f} ms since import")
+
+@app.on_event("shutdown")
+def stop_face_pool():
+    face_pool.shutdown()
+
+@app.get("/health")
+async def health():
+    """Liveness: the process is up and serving"""
+    return {"status": "ok"}
+
+@app.get("/ready")
+async def ready():
+    """Readiness: face endpoints can be served"""
+    face = face_runtime.status()
+    if not face_runtime.ready:
+        raise HTTPException(
+            status_code=503,
+            detail={"status": "starting", "face": face},
+            headers={"Retry-After": str(FACE_WARMUP_RETRY_AFTER)},
+        )
+    return {"status": "ready", "face": face}
+
+async def run_face_pipeline(compute, image_data):
+    try:
+        face_runtime.require_ready()
+        return await compute(image_data)
+    except FaceStackNotReady:
+        raise HTTPException(
+            status_code=503,
+            detail="Face recognition is starting up, please retry shortly",
+            headers={"Retry-After": str(FACE_WARMUP_RETRY_AFTER)},
+        )
+    except FacePoolSaturated:
+        raise HTTPException(
+            status_code=503,
+            detail="Face recognition is busy, please retry shortly",
+            headers={"Retry-After": str(FACE_POOL_RETRY_AFTER)},
+        )
+    except FrameQualityError as e:
+        quality_rejections[e.code] += 1
+        raise HTTPException(status_code=400, detail=e.message, headers={"X-Error-Code": e.code})
+
+def mark_present(db: Session, class_id: int, confidences, method="face", latitude=None, longitude=None):
+    """Insert and commit attendance for each user_id -> confidence in confidences
+
+    Users already marked for the class within the last hour are skipped
+    and returned, so callers can report or reject the duplicates.
+    """
+    already_marked = {
+        user_id for (user_id,) in db.query(Attendance.user_id).filter(
+            Attendance.user_id.in_(list(confidences)),
+            Attendance.class_id == class_id,
+            Attendance.timestamp > datetime.utcnow() - timedelta(hours=1)
+        ).distinct()
+    }
+    db.add_all([
+        Attendance(
+            user_id=user_id,
+            class_id=class_id,
+            method=method,
+            latitude=latitude,
+            longitude=longitude,
+            confidence=confidence,
+            is_valid=True
+        )
+        for user_id, confidence in confidences.items() if user_id not in already_marked
+    ])
+    db.commit()
+    return already_marked
+
+def identify_faces(db: Session, encodings, class_id: int):
+    """(user_id, confidence) for each encoding against the class roster; user_id is None when nobody matches"""
+    def load_templates(user_id):
+        blob = db.query(User.face_templates).filter(User.id == user_id).scalar()
+        return unpack_templates(blob) if blob is not None else None
+    
+    system = face_runtime.system()
+    return [
+        system.identify_face(encoding, class_id=class_id, load_templates=load_templates) if encoding is not None else (None, 0.0)
+        for encoding in encodings
+    ]
+
+async def encode_face_image(face_image):
+    try:
+        image_data = image_bytes(face_image)
+    except (ValueError, IndexError):
+        return None
+    
+    # Retries and re-submissions of the same picture are served from the cache
+    return await run_face_pipeline(lambda data: encoding_cache.get_or_compute(data, face_batcher.encode_face), image_data)
+
+async def read_face_upload(face_file: UploadFile):
+    # Raw JPEG/PNG bytes go to the decoder as-is, skipping the base64
+    # inflation and the data URL round trip
+    image_data = await face_file.read(FACE_MAX_UPLOAD_BYTES + 1)
+    if len(image_data) > FACE_MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="Image file is too large")
+    if not image_data:
+        raise HTTPException(status_code=400, detail="Empty image file")
+    return image_data
+
 @app.post("/register", response_model=UserResponse)
 async def register_user(user: UserCreate, db: Session = Depends(get_db)):
-    db_user = db.query(User).filter(User.username == user.username).first()
+    db_user = await run_db(db.query(User).filter(User.username == user.username).first)
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
     
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await hash_password(user.password)
     db_user = User(
         username=user.username,
         email=user.email,
@@ -86,26 +219,21 @@ async def register_user(user: UserCreate, db: Session = Depends(get_db)):
         role=user.role
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await run_db(db.commit)
+    await run_db(db.refresh, db_user)
     return db_user
 
 @app.post("/token", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
-    )
     return {
-        "access_token": access_token, 
-        "token_type": "bearer",
+        **create_user_tokens(user),
         "user": UserResponse(
             id=user.id,
             username=user.username,
@@ -116,18 +244,84 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
         )
     }
 
-@app.post("/upload-face")
-async def upload_face_encoding(face_image: str, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
-    face_encoding = face_system.encode_face_from_base64(face_image)
+@app.post("/token/refresh", response_model=Token)
+def refresh_access_token(refresh_data: RefreshRequest, db: Session = Depends(get_db)):
+    user, tokens = refresh_user_tokens(db, refresh_data.refresh_token)
+    return {
+        **tokens,
+        "user": UserResponse(
+            id=user.id,
+            username=user.username,
+            email=user.email,
+            full_name=user.full_name,
+            role=user.role,
+            is_active=user.is_active
+        )
+    }
+
+async def store_face_encoding(face_image, current_user: User, db: Session, replace: bool = False):
+    face_encoding = await encode_face_image(face_image)
     if not face_encoding:
         raise HTTPException(status_code=400, detail="No face detected in image")
     
-    current_user.face_encoding = json.dumps(face_encoding)
-    db.commit()
-    return {"message": "Face encoding uploaded successfully"}
+    # current_user is the token principal without the face columns
+    user = await run_db(db.query(User).options(undefer_group("face")).filter(User.id == current_user.id).first)
+
+    # Each upload adds a template; the gallery and first-pass matching use their centroid
+    existing = None if replace else stored_templates(user)
+    templates, pruned = add_template(existing, face_encoding)
+    user.face_templates = pack_templates(templates)
+    user.face_encoding_blob = pack_encoding(centroid(templates))
+    user.face_encoding = None
+    user.face_updated_at = datetime.utcnow()
+    
+    def save():
+        db.commit()
+        face_gallery.sync_user(user)
+    
+    await run_db(save)
+    return {"message": "Face encoding uploaded successfully", "templates": len(templates), "pruned": pruned}
+
+@app.post("/upload-face")
+async def upload_face_encoding(face_image: str, replace: bool = False, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+    return await store_face_encoding(face_image, current_user, db, replace)
+
+@app.post("/upload-face/file")
+async def upload_face_file(
+    face_file: UploadFile = File(...),
+    replace: bool = Form(False),
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    image_data = await read_face_upload(face_file)
+    return await store_face_encoding(image_data, current_user, db, replace)
+
+@app.get("/metrics/auth")
+async def get_auth_metrics(current_user: User = Depends(get_current_active_user)):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return {
+        "password_hasher": password_hasher.stats(),
+        "token_revocations": token_revocations.stats()
+    }
+
+@app.get("/metrics/face")
+async def get_face_metrics(current_user: User = Depends(get_current_active_user)):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return {
+        "pool": face_pool.stats(),
+        "batcher": face_batcher.stats(),
+        "cache": encoding_cache.stats(),
+        "runtime": face_runtime.status(),
+        "quality_rejections": dict(quality_rejections),
+        "stages": face_pool.stage_stats.summary()
+    }
 
 @app.post("/classes")
-async def create_class(class_data: ClassCreate, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def create_class(class_data: ClassCreate, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     if current_user.role not in ["admin", "teacher"]:
         raise HTTPException(status_code=403, detail="Not authorized to create classes")
     
@@ -147,7 +341,7 @@ async def create_class(class_data: ClassCreate, current_user: User = Depends(get
     return db_class
 
 @app.get("/classes")
-async def get_classes(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def get_classes(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     if current_user.role == "admin":
         return db.query(Class).all()
     elif current_user.role == "teacher":
@@ -157,7 +351,7 @@ async def get_classes(current_user: User = Depends(get_current_active_user), db:
         return [enrollment.class_obj for enrollment in enrollments]
 
 @app.post("/enroll/{class_id}")
-async def enroll_in_class(class_id: int, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def enroll_in_class(class_id: int, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     existing_enrollment = db.query(Enrollment).filter(
         Enrollment.user_id == current_user.id,
         Enrollment.class_id == class_id
@@ -168,20 +362,25 @@ async def enroll_in_class(class_id: int, current_user: User = Depends(get_curren
     
     enrollment = Enrollment(user_id=current_user.id, class_id=class_id)
     db.add(enrollment)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        # A concurrent request enrolled first (enrollments are unique per user and class)
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Already enrolled in this class")
+    face_gallery.enroll(class_id, current_user.id)
     return {"message": "Enrolled successfully"}
 
-@app.post("/attendance")
-async def mark_attendance(attendance_data: AttendanceCreate, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
-    class_obj = db.query(Class).filter(Class.id == attendance_data.class_id).first()
+async def record_attendance(attendance_data: AttendanceCreate, face_image, current_user: User, db: Session):
+    class_obj = await run_db(db.query(Class).filter(Class.id == attendance_data.class_id).first)
     if not class_obj:
         raise HTTPException(status_code=404, detail="Class not found")
     
     # Check if user is enrolled
-    enrollment = db.query(Enrollment).filter(
+    enrollment = await run_db(db.query(Enrollment).filter(
         Enrollment.user_id == current_user.id,
         Enrollment.class_id == attendance_data.class_id
-    ).first()
+    ).first)
     
     if not enrollment and current_user.role == "student":
         raise HTTPException(status_code=403, detail="Not enrolled in this class")
@@ -196,47 +395,250 @@ async def mark_attendance(attendance_data: AttendanceCreate, current_user: User
             raise HTTPException(status_code=400, detail="Not within class location")
     
     confidence = 1.0
-    is_valid = True
     
     # Face recognition verification
-    if attendance_data.method == "face" and attendance_data.face_image:
-        if not current_user.face_encoding:
+    if attendance_data.method == "face" and face_image:
+        # The token principal has no face columns, read them for this check only
+        face_user = await run_db(db.query(User).options(undefer_group("face")).filter(User.id == current_user.id).first)
+        known_encoding = stored_encoding(face_user)
+        if known_encoding is None:
             raise HTTPException(status_code=400, detail="No face encoding registered")
         
-        face_encoding = face_system.encode_face_from_base64(attendance_data.face_image)
+        face_encoding = await encode_face_image(face_image)
         if not face_encoding:
             raise HTTPException(status_code=400, detail="No face detected")
         
-        match, confidence = face_system.compare_faces(current_user.face_encoding, face_encoding)
+        match, confidence = face_runtime.system().compare_faces(known_encoding, face_encoding, templates=stored_templates(face_user))
         if not match:
             raise HTTPException(status_code=400, detail="Face verification failed")
     
-    # Check for duplicate attendance (within 1 hour)
-    recent_attendance = db.query(Attendance).filter(
-        Attendance.user_id == current_user.id,
-        Attendance.class_id == attendance_data.class_id,
-        Attendance.timestamp > datetime.utcnow() - timedelta(hours=1)
-    ).first()
-    
-    if recent_attendance:
-        raise HTTPException(status_code=400, detail="Attendance already marked recently")
-    
-    attendance = Attendance(
-        user_id=current_user.id,
-        class_id=attendance_data.class_id,
-        method=attendance_data.method,
-        latitude=attendance_data.latitude,
-        longitude=attendance_data.longitude,
-        confidence=confidence,
-        is_valid=is_valid
-    )
+    def save():
+        already_marked = mark_present(
+            db, attendance_data.class_id, {current_user.id: confidence},
+            method=attendance_data.method,
+            latitude=attendance_data.latitude,
+            longitude=attendance_data.longitude
+        )
+        if already_marked:
+            raise HTTPException(status_code=400, detail="Attendance already marked recently")
     
-    db.add(attendance)
-    db.commit()
+    await run_db(save)
     return {"message": "Attendance marked successfully", "confidence": confidence}
 
+@app.post("/attendance")
+async def mark_attendance(attendance_data: AttendanceCreate, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+    return await record_attendance(attendance_data, attendance_data.face_image, current_user, db)
+
+@app.post("/attendance/face")
+async def mark_attendance_file(
+    class_id: int = Form(...),
+    latitude: Optional[float] = Form(None),
+    longitude: Optional[float] = Form(None),
+    face_file: UploadFile = File(...),
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    image_data = await read_face_upload(face_file)
+    attendance_data = AttendanceCreate(class_id=class_id, method="face", latitude=latitude, longitude=longitude)
+    return await record_attendance(attendance_data, image_data, current_user, db)
+
+async def identify_and_record(class_id: int, face_image, current_user: User, db: Session):
+    if current_user.role not in ["admin", "teacher"]:
+        raise HTTPException(status_code=403, detail="Not authorized to run face identification")
+    
+    class_obj = await run_db(db.query(Class).filter(Class.id == class_id).first)
+    if not class_obj:
+        raise HTTPException(status_code=404, detail="Class not found")
+    
+    face_encoding = await encode_face_image(face_image)
+    if not face_encoding:
+        raise HTTPException(status_code=400, detail="No face detected")
+    
+    # Only the class roster is a plausible match; templates may be read
+    # near the match boundary, so the search runs off the loop too
+    [(user_id, confidence)] = await run_db(identify_faces, db, [face_encoding], class_id)
+    if user_id is None:
+        raise HTTPException(status_code=404, detail="Face not recognized")
+    
+    def save():
+        student = db.query(User).filter(User.id == user_id).first()
+        if not student or not student.is_active:
+            raise HTTPException(status_code=404, detail="Face not recognized")
+        
+        if mark_present(db, class_id, {student.id: confidence}):
+            raise HTTPException(status_code=400, detail="Attendance already marked recently")
+        return {
+            "message": "Attendance marked successfully",
+            "user_id": student.id,
+            "full_name": student.full_name,
+            "confidence": confidence
+        }
+    
+    return await run_db(save)
+
+@app.post("/attendance/identify")
+async def identify_attendance(identify_data: IdentifyRequest, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+    return await identify_and_record(identify_data.class_id, identify_data.face_image, current_user, db)
+
+@app.post("/attendance/identify/file")
+async def identify_attendance_file(
+    class_id: int = Form(...),
+    face_file: UploadFile = File(...),
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    image_data = await read_face_upload(face_file)
+    return await identify_and_record(class_id, image_data, current_user, db)
+
+async def mark_group_attendance(class_id: int, face_image, current_user: User, db: Session):
+    if current_user.role not in ["admin", "teacher"]:
+        raise HTTPException(status_code=403, detail="Not authorized to run face identification")
+    
+    class_obj = await run_db(db.query(Class).filter(Class.id == class_id).first)
+    if not class_obj:
+        raise HTTPException(status_code=404, detail="Class not found")
+    
+    try:
+        image_data = image_bytes(face_image)
+    except (ValueError, IndexError):
+        raise HTTPException(status_code=400, detail="Invalid image data")
+    
+    # One detection pass and one encoding call for the whole room
+    faces = await run_face_pipeline(face_pool.encode_all_faces, image_data)
+    if not faces:
+        raise HTTPException(status_code=400, detail="No faces detected")
+    
+    # A roster change by another worker is reloaded from the database, so match off the loop
+    matches = await run_db(face_gallery.match_roster, [encoding for _, encoding in faces], class_id)
+    matched_ids = [user_id for _, user_id, _ in matches]
+    
+    def save():
+        students = {}
+        if matched_ids:
+            students = {
+                student.id: student for student in
+                db.query(User).filter(User.id.in_(matched_ids), User.is_active == True).all()
+            }
+        
+        # Duplicates for everyone are checked in one query
+        present = [(probe_index, user_id, 1 - distance) for probe_index, user_id, distance in matches if user_id in students]
+        already_marked = mark_present(db, class_id, {user_id: confidence for _, user_id, confidence in present})
+        marked = [
+            {
+                "user_id": user_id,
+                "full_name": students[user_id].full_name,
+                "confidence": confidence,
+                "location": faces[probe_index][0]
+            }
+            for probe_index, user_id, confidence in present if user_id not in already_marked
+        ]
+        return {
+            "message": f"Attendance marked for {len(marked)} students",
+            "faces_detected": len(faces),
+            "marked": marked,
+            "already_marked": sorted(already_marked),
+            "unrecognized": len(faces) - len(matches)
+        }
+    
+    return await run_db(save)
+
+@app.post("/attendance/group")
+async def group_attendance(identify_data: IdentifyRequest, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+    return await mark_group_attendance(identify_data.class_id, identify_data.face_image, current_user, db)
+
+@app.post("/attendance/group/file")
+async def group_attendance_file(
+    class_id: int = Form(...),
+    face_file: UploadFile = File(...),
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    image_data = await read_face_upload(face_file)
+    return await mark_group_attendance(class_id, image_data, current_user, db)
+
+def record_stream_attendance(class_id: int, user_id: int, confidence: float):
+    db = SessionLocal()
+    try:
+        student = db.query(User).filter(User.id == user_id).first()
+        if not student or not student.is_active:
+            return None
+        
+        already_marked = mark_present(db, class_id, {user_id: confidence})
+        return {
+            "event": "attendance",
+            "user_id": user_id,
+            "full_name": student.full_name,
+            "confidence": confidence,
+            "status": "already_marked" if already_marked else "marked"
+        }
+    finally:
+        db.close()
+
+def identify_stream_faces(class_id: int, encodings):
+    db = SessionLocal()
+    try:
+        return identify_faces(db, encodings, class_id)
+    finally:
+        db.close()
+
+@app.websocket("/ws/attendance/{class_id}")
+async def attendance_stream(websocket: WebSocket, class_id: int, token: str):
+    """Kiosk camera stream: send JPEG frames as binary (or data URLs as text) messages"""
+    db = SessionLocal()
+    try:
+        try:
+            current_user = await get_current_active_user(await get_current_user(token, db))
+        except HTTPException:
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+            return
+        class_obj = await run_db(db.query(Class).filter(Class.id == class_id).first)
+    finally:
+        db.close()
+    
+    if current_user.role not in ["admin", "teacher"] or not class_obj:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    try:
+        face_runtime.require_ready()
+    except FaceStackNotReady:
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        return
+    
+    await websocket.accept()
+    send_lock = asyncio.Lock()
+    
+    async def send(message):
+        async with send_lock:
+            try:
+                await websocket.send_json(message)
+            except Exception:
+                pass
+    
+    async def identify(encodings):
+        return await run_db(identify_stream_faces, class_id, encodings)
+    
+    async def on_recognized(user_id, confidence):
+        event = await run_db(record_stream_attendance, class_id, user_id, confidence)
+        if event:
+            await send(event)
+    
+    session = FaceStreamSession(class_id, identify, on_recognized, send)
+    worker = asyncio.ensure_future(session.run())
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            frame = message.get("bytes") or message.get("text")
+            if frame:
+                session.push(frame)
+    finally:
+        session.close()
+        await worker
+        print(f"Attendance stream for class {class_id} closed: {session.stats()}")
+
 @app.get("/attendance/{class_id}")
-async def get_attendance(class_id: int, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def get_attendance(class_id: int, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     class_obj = db.query(Class).filter(Class.id == class_id).first()
     if not class_obj:
         raise HTTPException(status_code=404, detail="Class not found")
@@ -252,7 +654,7 @@ async def get_attendance(class_id: int, current_user: User = Depends(get_current
     return attendances
 
 @app.get("/dashboard/stats")
-async def get_dashboard_stats(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def get_dashboard_stats(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     if current_user.role == "admin":
         total_users = db.query(User).count()
         total_classes = db.query(Class).count()
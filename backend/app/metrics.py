@@ -0,0 +1,57 @@
+import threading
+from collections import deque
+import numpy as np
+
+class LatencyStats:
+    """Rolling latency samples in milliseconds with percentile summaries"""
+
+    def __init__(self, window=1000):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, ms):
+        with self._lock:
+            self.count += 1
+            self.total_ms += ms
+            self.max_ms = max(self.max_ms, ms)
+            self._samples.append(ms)
+
+    def summary(self):
+        with self._lock:
+            samples = np.array(self._samples, dtype=np.float64)
+            count, total_ms, max_ms = self.count, self.total_ms, self.max_ms
+        if count == 0:
+            return {"count": 0}
+        p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+        return {
+            "count": count,
+            "mean_ms": round(total_ms / count, 3),
+            "p50_ms": round(float(p50), 3),
+            "p95_ms": round(float(p95), 3),
+            "p99_ms": round(float(p99), 3),
+            "max_ms": round(max_ms, 3)
+        }
+
+class StageStats:
+    """One LatencyStats per named pipeline stage"""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, timings):
+        for stage, ms in timings.items():
+            with self._lock:
+                stats = self._stages.get(stage)
+                if stats is None:
+                    stats = self._stages[stage] = LatencyStats(self.window)
+            stats.record(ms)
+
+    def summary(self):
+        with self._lock:
+            stages = dict(self._stages)
+        return {stage: stats.summary() for stage, stats in stages.items()}
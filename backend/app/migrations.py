@@ -0,0 +1,168 @@
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import inspect, select, text, func, Column, DateTime, Integer, LargeBinary, MetaData, String, Table
+from sqlalchemy.exc import IntegrityError
+
+# Applied versions are recorded here; create_all cannot change existing tables
+SCHEMA_VERSION_TABLE = "schema_version"
+schema_version_table = Table(
+    SCHEMA_VERSION_TABLE, MetaData(),
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("description", String),
+    Column("applied_at", DateTime)
+)
+# PostgreSQL advisory lock id held while migrating, so workers starting together take turns
+MIGRATION_LOCK_ID = 0x61747464
+
+def _columns(conn, table):
+    return [column["name"] for column in inspect(conn).get_columns(table)]
+
+def _add_column(conn, table, column, column_type):
+    # Type names differ between backends (BLOB on SQLite, BYTEA on PostgreSQL)
+    type_sql = column_type.compile(dialect=conn.dialect)
+    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {type_sql}"))
+
+def _face_encoding_blobs(conn):
+    """Binary encoding columns, converting legacy JSON encodings into them"""
+    from .face_encoding_codec import pack_encoding, unpack_encoding
+
+    columns = _columns(conn, "users")
+    if "face_encoding_blob" not in columns:
+        _add_column(conn, "users", "face_encoding_blob", LargeBinary())
+    if "face_templates" not in columns:
+        _add_column(conn, "users", "face_templates", LargeBinary())
+    if "face_encoding" not in columns:
+        return
+
+    rows = conn.execute(text(
+        "SELECT id, face_encoding FROM users "
+        "WHERE face_encoding IS NOT NULL AND face_encoding_blob IS NULL"
+    )).fetchall()
+    converted = 0
+    failed = []
+    for user_id, face_encoding in rows:
+        try:
+            blob = pack_encoding(unpack_encoding(face_encoding))
+        except (TypeError, ValueError):
+            failed.append(user_id)
+            continue
+        conn.execute(
+            text("UPDATE users SET face_encoding_blob = :blob, face_encoding = NULL WHERE id = :id"),
+            {"blob": blob, "id": user_id}
+        )
+        converted += 1
+    if converted:
+        print(f"Converted {converted} JSON face encodings to binary")
+    if failed:
+        print(f"Left {len(failed)} unreadable JSON face encodings in place (user ids {failed})")
+
+    # A single packed encoding is also a valid one-row template block
+    conn.execute(text(
+        "UPDATE users SET face_templates = face_encoding_blob "
+        "WHERE face_templates IS NULL AND face_encoding_blob IS NOT NULL"
+    ))
+
+def _token_versions(conn):
+    if "token_version" not in _columns(conn, "users"):
+        conn.execute(text("ALTER TABLE users ADD COLUMN token_version INTEGER NOT NULL DEFAULT 0"))
+
+def _attendance_indexes(conn):
+    """Composite indexes for the duplicate, roster and trend queries"""
+    # Older databases may hold repeated enrollments; keep the first of each
+    duplicates = conn.execute(text(
+        "SELECT id, user_id, class_id FROM enrollments WHERE id NOT IN "
+        "(SELECT MIN(id) FROM enrollments GROUP BY user_id, class_id)"
+    )).fetchall()
+    for enrollment_id, user_id, class_id in duplicates:
+        conn.execute(text("DELETE FROM enrollments WHERE id = :id"), {"id": enrollment_id})
+        print(f"Removed duplicate enrollment {enrollment_id} (user {user_id}, class {class_id})")
+    conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_enrollments_user_class ON enrollments (user_id, class_id)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_attendances_user_class_time ON attendances (user_id, class_id, timestamp)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_attendances_class_time ON attendances (class_id, timestamp)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_attendances_time ON attendances (timestamp)"
+    ))
+
+def _face_updated_at(conn):
+    if "face_updated_at" not in _columns(conn, "users"):
+        _add_column(conn, "users", "face_updated_at", DateTime())
+
+# (version, description, step); append only, never renumber. Every step
+# must also cope with databases that got the change before this table existed.
+MIGRATIONS = [
+    (1, "binary face encodings and templates", _face_encoding_blobs),
+    (2, "users.token_version", _token_versions),
+    (3, "attendance and enrollment indexes", _attendance_indexes),
+    (4, "users.face_updated_at", _face_updated_at),
+]
+
+def _applied(conn):
+    return {version for (version,) in conn.execute(select(schema_version_table.c.version))}
+
+def _apply(conn, version, description, step):
+    if version in _applied(conn):
+        return False
+    step(conn)
+    conn.execute(schema_version_table.insert().values(
+        version=version, description=description, applied_at=datetime.utcnow()
+    ))
+    return True
+
+@contextmanager
+def _locked(bind):
+    """A transaction holding the migration lock, so workers starting together
+    run each version check and step one at a time"""
+    if bind.dialect.name == "sqlite":
+        # BEGIN IMMEDIATE takes the write lock before anything is read
+        with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except Exception:
+                conn.exec_driver_sql("ROLLBACK")
+                raise
+            conn.exec_driver_sql("COMMIT")
+    else:
+        with bind.begin() as conn:
+            if bind.dialect.name == "postgresql":
+                # Released with the transaction
+                conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+            yield conn
+
+def _locks_migrations(bind):
+    return bind.dialect.name in ("sqlite", "postgresql")
+
+def run_migrations(bind):
+    """Bring the schema up to the latest version; returns the versions applied now"""
+    try:
+        with _locked(bind) as conn:
+            schema_version_table.create(conn, checkfirst=True)
+    except Exception:
+        # Other backends take no lock; another worker may have created it first
+        if _locks_migrations(bind) or not inspect(bind).has_table(SCHEMA_VERSION_TABLE):
+            raise
+
+    applied = []
+    for version, description, step in MIGRATIONS:
+        try:
+            with _locked(bind) as conn:
+                done = _apply(conn, version, description, step)
+        except IntegrityError:
+            # Unlocked backends: another worker recorded this version first
+            if _locks_migrations(bind) or schema_version(bind) < version:
+                raise
+            done = False
+        if done:
+            applied.append(version)
+            print(f"Applied schema migration {version}: {description}")
+    return applied
+
+def schema_version(bind):
+    with bind.connect() as conn:
+        return conn.execute(select(func.max(schema_version_table.c.version))).scalar() or 0
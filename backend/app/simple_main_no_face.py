@@ -1,15 +1,17 @@
 from fastapi import FastAPI, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, undefer_group
 from datetime import datetime, timedelta
 from typing import List, Optional
 from pydantic import BaseModel
 import json
 import math
 
-from .database import get_db, User, Class, Attendance, Enrollment
-from .auth import authenticate_user, create_access_token, get_current_active_user, get_password_hash, ACCESS_TOKEN_EXPIRE_MINUTES
+from .database import get_db, run_db, database_settings, SessionLocal, User, Class, Attendance, Enrollment
+from .auth import authenticate_user, create_user_tokens, refresh_user_tokens, revoke_user_tokens, token_revocations, get_current_active_user, hash_password, password_hasher
+from .face_gallery import face_gallery
 try:
     from .notification_service import NotificationService
 except ImportError:
@@ -71,20 +73,37 @@ class Token(BaseModel):
     access_token: str
     token_type: str
     user: UserResponse
+    refresh_token: Optional[str] = None
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 class LoginRequest(BaseModel):
     username: str
     password: str
 
+@app.on_event("startup")
+def report_database_settings():
+    print(f"Database: {database_settings()}")
+
+@app.on_event("startup")
+def load_face_gallery():
+    # Loaded even without AI so admin edits keep the shared snapshot in sync
+    db = SessionLocal()
+    try:
+        face_gallery.load(db)
+    finally:
+        db.close()
+
 @app.post("/register", response_model=UserResponse)
 async def register_user(user: UserCreate, db: Session = Depends(get_db)):
     # Check if username exists
-    db_user = db.query(User).filter(User.username == user.username).first()
+    db_user = await run_db(db.query(User).filter(User.username == user.username).first)
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
     
     # Check if email exists
-    db_email = db.query(User).filter(User.email == user.email).first()
+    db_email = await run_db(db.query(User).filter(User.email == user.email).first)
     if db_email:
         raise HTTPException(status_code=400, detail="Email already registered")
     
@@ -104,7 +123,7 @@ async def register_user(user: UserCreate, db: Session = Depends(get_db)):
     if user.role not in ['admin', 'teacher', 'student']:
         raise HTTPException(status_code=400, detail="Invalid role. Must be admin, teacher, or student")
     
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await hash_password(user.password)
     db_user = User(
         username=user.username.lower().strip(),
         email=user.email.lower().strip(),
@@ -118,8 +137,8 @@ async def register_user(user: UserCreate, db: Session = Depends(get_db)):
         is_active=True
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await run_db(db.commit)
+    await run_db(db.refresh, db_user)
     return db_user
 
 @app.post("/admin/create-user", response_model=UserResponse)
@@ -128,12 +147,12 @@ async def admin_create_user(user: UserCreate, current_user: User = Depends(get_c
         raise HTTPException(status_code=403, detail="Admin access required")
     
     # Check if username exists
-    db_user = db.query(User).filter(User.username == user.username).first()
+    db_user = await run_db(db.query(User).filter(User.username == user.username).first)
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
     
     # Check if email exists
-    db_email = db.query(User).filter(User.email == user.email).first()
+    db_email = await run_db(db.query(User).filter(User.email == user.email).first)
     if db_email:
         raise HTTPException(status_code=400, detail="Email already registered")
     
@@ -153,7 +172,7 @@ async def admin_create_user(user: UserCreate, current_user: User = Depends(get_c
     if user.role not in ['admin', 'teacher', 'student']:
         raise HTTPException(status_code=400, detail="Invalid role. Must be admin, teacher, or student")
     
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await hash_password(user.password)
     db_user = User(
         username=user.username.lower().strip(),
         email=user.email.lower().strip(),
@@ -163,8 +182,8 @@ async def admin_create_user(user: UserCreate, current_user: User = Depends(get_c
         is_active=True
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await run_db(db.commit)
+    await run_db(db.refresh, db_user)
     return db_user
 
 @app.post("/token", response_model=Token)
@@ -172,10 +191,10 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     # Normalize username
     username = form_data.username.lower().strip()
     
-    user = authenticate_user(db, username, form_data.password)
+    user = await authenticate_user(db, username, form_data.password)
     if not user:
         # Check if user exists but password is wrong
-        existing_user = db.query(User).filter(User.username == username).first()
+        existing_user = await run_db(db.query(User).filter(User.username == username).first)
         if existing_user:
             if not existing_user.is_active:
                 raise HTTPException(
@@ -196,13 +215,23 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
                 headers={"WWW-Authenticate": "Bearer"},
             )
     
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
-    )
     return {
-        "access_token": access_token, 
-        "token_type": "bearer",
+        **create_user_tokens(user),
+        "user": UserResponse(
+            id=user.id,
+            username=user.username,
+            email=user.email,
+            full_name=user.full_name,
+            role=user.role,
+            is_active=user.is_active
+        )
+    }
+
+@app.post("/token/refresh", response_model=Token)
+def refresh_access_token(refresh_data: RefreshRequest, db: Session = Depends(get_db)):
+    user, tokens = refresh_user_tokens(db, refresh_data.refresh_token)
+    return {
+        **tokens,
         "user": UserResponse(
             id=user.id,
             username=user.username,
@@ -217,9 +246,9 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 async def login_alternative(login_data: LoginRequest, db: Session = Depends(get_db)):
     username = login_data.username.lower().strip()
     
-    user = authenticate_user(db, username, login_data.password)
+    user = await authenticate_user(db, username, login_data.password)
     if not user:
-        existing_user = db.query(User).filter(User.username == username).first()
+        existing_user = await run_db(db.query(User).filter(User.username == username).first)
         if existing_user:
             if not existing_user.is_active:
                 raise HTTPException(status_code=401, detail="Account is deactivated")
@@ -228,13 +257,8 @@ async def login_alternative(login_data: LoginRequest, db: Session = Depends(get_
         else:
             raise HTTPException(status_code=401, detail="Username not found")
     
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
-    )
     return {
-        "access_token": access_token, 
-        "token_type": "bearer",
+        **create_user_tokens(user),
         "user": UserResponse(
             id=user.id,
             username=user.username,
@@ -246,7 +270,7 @@ async def login_alternative(login_data: LoginRequest, db: Session = Depends(get_
     }
 
 @app.post("/classes")
-async def create_class(class_data: ClassCreate, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def create_class(class_data: ClassCreate, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     if current_user.role not in ["admin", "teacher"]:
         raise HTTPException(status_code=403, detail="Not authorized to create classes")
     
@@ -277,7 +301,7 @@ async def create_class(class_data: ClassCreate, current_user: User = Depends(get
     return db_class
 
 @app.get("/classes")
-async def get_classes(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def get_classes(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     if current_user.role == "admin":
         return db.query(Class).all()
     elif current_user.role == "teacher":
@@ -287,7 +311,7 @@ async def get_classes(current_user: User = Depends(get_current_active_user), db:
         return [enrollment.class_obj for enrollment in enrollments]
 
 @app.post("/enroll/{class_id}")
-async def enroll_in_class(class_id: int, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def enroll_in_class(class_id: int, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     existing_enrollment = db.query(Enrollment).filter(
         Enrollment.user_id == current_user.id,
         Enrollment.class_id == class_id
@@ -298,11 +322,17 @@ async def enroll_in_class(class_id: int, current_user: User = Depends(get_curren
     
     enrollment = Enrollment(user_id=current_user.id, class_id=class_id)
     db.add(enrollment)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        # A concurrent request enrolled first (enrollments are unique per user and class)
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Already enrolled in this class")
+    face_gallery.enroll(class_id, current_user.id)
     return {"message": "Enrolled successfully"}
 
 @app.post("/attendance")
-async def mark_attendance(attendance_data: AttendanceCreate, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def mark_attendance(attendance_data: AttendanceCreate, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     class_obj = db.query(Class).filter(Class.id == attendance_data.class_id).first()
     if not class_obj:
         raise HTTPException(status_code=404, detail="Class not found")
@@ -351,7 +381,7 @@ async def mark_attendance(attendance_data: AttendanceCreate, current_user: User
     return {"message": "Attendance marked successfully", "confidence": 1.0}
 
 @app.get("/attendance/{class_id}")
-async def get_attendance(class_id: int, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def get_attendance(class_id: int, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     class_obj = db.query(Class).filter(Class.id == class_id).first()
     if not class_obj:
         raise HTTPException(status_code=404, detail="Class not found")
@@ -378,7 +408,7 @@ async def get_current_user_info(current_user: User = Depends(get_current_active_
     )
 
 @app.get("/users", response_model=List[UserResponse])
-async def get_all_users(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def get_all_users(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
     
@@ -393,7 +423,7 @@ async def get_all_users(current_user: User = Depends(get_current_active_user), d
     ) for user in users]
 
 @app.delete("/users/{user_id}")
-async def delete_user(user_id: int, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def delete_user(user_id: int, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
     
@@ -406,6 +436,8 @@ async def delete_user(user_id: int, current_user: User = Depends(get_current_act
     
     db.delete(user)
     db.commit()
+    token_revocations.revoke_all(user_id)
+    face_gallery.remove(user_id)
     return {"message": "User deleted successfully"}
 
 @app.put("/users/{user_id}", response_model=UserResponse)
@@ -413,7 +445,8 @@ async def update_user(user_id: int, user_data: UserCreate, current_user: User =
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    user = db.query(User).filter(User.id == user_id).first()
+    # undefer: face_gallery.sync_user reads the encoding once the change is saved
+    user = await run_db(db.query(User).options(undefer_group("face")).filter(User.id == user_id).first)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -423,10 +456,15 @@ async def update_user(user_id: int, user_data: UserCreate, current_user: User =
     user.role = user_data.role or user.role
     
     if user_data.password:
-        user.hashed_password = get_password_hash(user_data.password)
+        user.hashed_password = await hash_password(user_data.password)
     
-    db.commit()
-    db.refresh(user)
+    def save():
+        # Tokens carry the old username and role, make the user sign in again
+        revoke_user_tokens(db, user)
+        db.refresh(user)
+        face_gallery.sync_user(user)
+    
+    await run_db(save)
     
     return UserResponse(
         id=user.id,
@@ -438,7 +476,7 @@ async def update_user(user_id: int, user_data: UserCreate, current_user: User =
     )
 
 @app.get("/dashboard/stats")
-async def get_dashboard_stats(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def get_dashboard_stats(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     if current_user.role == "admin":
         total_users = db.query(User).count()
         total_classes = db.query(Class).count()
@@ -466,7 +504,7 @@ async def get_dashboard_stats(current_user: User = Depends(get_current_active_us
         }
 
 @app.get("/analytics/attendance-trends")
-async def get_attendance_trends(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def get_attendance_trends(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     if current_user.role not in ["admin", "teacher"]:
         raise HTTPException(status_code=403, detail="Access denied")
     
@@ -493,7 +531,7 @@ async def get_attendance_trends(current_user: User = Depends(get_current_active_
     return {"trends": trends[::-1]}  # Reverse to show oldest first
 
 @app.get("/analytics/user-roles")
-async def get_user_role_distribution(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def get_user_role_distribution(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
     
@@ -508,6 +546,16 @@ async def get_user_role_distribution(current_user: User = Depends(get_current_ac
         } for role, count in role_counts]
     }
 
+@app.get("/metrics/auth")
+async def get_auth_metrics(current_user: User = Depends(get_current_active_user)):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return {
+        "password_hasher": password_hasher.stats(),
+        "token_revocations": token_revocations.stats()
+    }
+
 @app.get("/health")
 async def health_check():
     return {
@@ -518,7 +566,7 @@ async def health_check():
     }
 
 @app.get("/notifications/preferences")
-async def get_notification_preferences(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def get_notification_preferences(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     if not NotificationService:
         return {"preferences": ["email", "sms"]}
     notification_service = NotificationService(db)
@@ -526,7 +574,7 @@ async def get_notification_preferences(current_user: User = Depends(get_current_
     return {"preferences": preferences}
 
 @app.put("/notifications/preferences")
-async def update_notification_preferences(preferences: NotificationPreferences, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def update_notification_preferences(preferences: NotificationPreferences, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     if not NotificationService:
         return {"message": "Notification service not available"}
     notification_service = NotificationService(db)
@@ -537,7 +585,7 @@ async def update_notification_preferences(preferences: NotificationPreferences,
         raise HTTPException(status_code=400, detail="Failed to update preferences")
 
 @app.post("/notifications/test")
-async def send_test_notification(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def send_test_notification(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     if not NotificationService:
         return {"message": "Notification service not available"}
     notification_service = NotificationService(db)
@@ -545,7 +593,7 @@ async def send_test_notification(current_user: User = Depends(get_current_active
     return {"message": "Test notification sent"}
 
 @app.post("/notifications/daily-summary")
-async def send_daily_summary(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def send_daily_summary(current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     if not NotificationService:
         return {"message": "Notification service not available"}
     notification_service = NotificationService(db)
@@ -553,7 +601,7 @@ async def send_daily_summary(current_user: User = Depends(get_current_active_use
     return {"message": "Daily summary sent"}
 
 @app.post("/notifications/meeting-reminder/{class_id}")
-async def send_meeting_reminder(class_id: int, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
+def send_meeting_reminder(class_id: int, current_user: User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     if current_user.role not in ["admin", "teacher"]:
         raise HTTPException(status_code=403, detail="Not authorized")
     
@@ -0,0 +1,91 @@
+"""Recall vs latency of the IVF face index against exact brute-force search
+
+Run from the backend directory:
+
+    python -m benchmarks.ann_benchmark --size 300000 --nprobe 1 4 8 16 32
+"""
+import argparse
+import json
+import time
+import numpy as np
+
+from app.face_ann import IVFIndex
+
+def synthetic_gallery(size, dim=128, seed=0):
+    # dlib descriptors of different people sit roughly 0.9 apart and
+    # repeat photos of one person within ~0.4, so scale the noise to match
+    rng = np.random.default_rng(seed)
+    gallery = rng.normal(0.0, 0.9 / np.sqrt(2 * dim), size=(size, dim)).astype(np.float32)
+    return gallery
+
+def probes_for(gallery, count, seed=1):
+    rng = np.random.default_rng(seed)
+    targets = rng.choice(len(gallery), count, replace=False)
+    noise = rng.normal(0.0, 0.35 / np.sqrt(gallery.shape[1]), size=(count, gallery.shape[1])).astype(np.float32)
+    return targets, gallery[targets] + noise
+
+def exact_search(gallery, sq_norms, probe):
+    return int(np.argmin(sq_norms - 2.0 * (gallery @ probe)))
+
+def percentile_ms(samples, q):
+    return round(float(np.percentile(samples, q)) * 1000.0, 3)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32, 64])
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    gallery = synthetic_gallery(args.size)
+    targets, probes = probes_for(gallery, args.queries)
+    sq_norms = np.einsum("ij,ij->i", gallery, gallery)
+
+    started = time.perf_counter()
+    index = IVFIndex(gallery.shape[1])
+    index.train(gallery, nlist=args.nlist)
+    index.add(np.arange(len(gallery)), gallery)
+    build_s = time.perf_counter() - started
+    print(f"gallery={args.size} nlist={index.nlist} build={build_s:.2f}s")
+
+    timings = []
+    truth = []
+    for probe in probes:
+        started = time.perf_counter()
+        truth.append(exact_search(gallery, sq_norms, probe))
+        timings.append(time.perf_counter() - started)
+    results = {
+        "size": args.size,
+        "queries": args.queries,
+        "nlist": index.nlist,
+        "build_s": round(build_s, 3),
+        "exact": {"p50_ms": percentile_ms(timings, 50), "p99_ms": percentile_ms(timings, 99)},
+        "ivf": []
+    }
+    print(f"exact      p50={results['exact']['p50_ms']}ms p99={results['exact']['p99_ms']}ms")
+
+    for nprobe in args.nprobe:
+        timings = []
+        hits = 0
+        for probe, expected in zip(probes, truth):
+            started = time.perf_counter()
+            found, _ = index.search(probe, nprobe=nprobe)
+            timings.append(time.perf_counter() - started)
+            hits += found == expected
+        row = {
+            "nprobe": nprobe,
+            "recall_at_1": round(hits / len(probes), 4),
+            "p50_ms": percentile_ms(timings, 50),
+            "p99_ms": percentile_ms(timings, 99)
+        }
+        results["ivf"].append(row)
+        print(f"nprobe={nprobe:<4} recall@1={row['recall_at_1']:.4f} p50={row['p50_ms']}ms p99={row['p99_ms']}ms")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
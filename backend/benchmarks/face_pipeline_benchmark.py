@@ -0,0 +1,225 @@
+"""Stage timings and throughput of the face pipeline on synthetic or real images
+
+Run from the backend directory:
+
+    python -m benchmarks.face_pipeline_benchmark --json before.json
+    python -m benchmarks.face_pipeline_benchmark --json after.json --compare before.json
+
+Synthetic frames contain no real faces, so detection mostly comes back
+empty for them; encoding is timed separately on fixed boxes, which costs
+the same for dlib whether or not a face is inside. Pass --images with a
+directory of photos to time the full path on real faces.
+"""
+import argparse
+import base64
+import glob
+import json
+import os
+import platform
+import time
+import cv2
+import numpy as np
+
+from app.face_recognition_utils import face_system, FACE_DETECTION_MODEL, FACE_DETECTION_WIDTH
+from app.face_gallery import FaceGallery
+from app.metrics import LatencyStats, StageStats
+
+def synthetic_frame(width, height, seed=0):
+    # Blocky texture plus sensor-like noise: sharp and well exposed enough
+    # to pass the frame quality filter, and realistic to JPEG-decode
+    rng = np.random.default_rng(seed)
+    blocks = rng.integers(60, 200, size=(max(height // 40, 2), max(width // 40, 2), 3), dtype=np.uint8)
+    frame = cv2.resize(blocks, (width, height), interpolation=cv2.INTER_NEAREST).astype(np.int16)
+    frame += rng.integers(-12, 13, size=frame.shape, dtype=np.int16)
+    ok, encoded = cv2.imencode(".jpg", np.clip(frame, 0, 255).astype(np.uint8), [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return encoded.tobytes()
+
+def face_boxes(width, height, faces):
+    # A grid of face-sized (top, right, bottom, left) boxes
+    columns = int(np.ceil(np.sqrt(faces)))
+    rows = int(np.ceil(faces / columns))
+    size = min(width // (columns * 2), height // (rows * 2))
+    boxes = []
+    for index in range(faces):
+        top = (index // columns) * 2 * size + size // 2
+        left = (index % columns) * 2 * size + size // 2
+        boxes.append((top, left + size, top + size, left))
+    return boxes
+
+def data_url(image_data):
+    return "data:image/jpeg;base64," + base64.b64encode(image_data).decode()
+
+def parse_size(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+def detect_then_encode(image, timings):
+    # Check for a face, then encode it, sharing one decode and detection
+    face_image = face_system.load(image, timings)
+    if face_system.detect_face_in_image(face_image)[0]:
+        face_system.encode_face(face_image)
+
+def run_case(name, fn, iterations, params=None, warmup=2):
+    """Call fn(timings) repeatedly, returning latency percentiles, throughput and per-stage percentiles"""
+    for _ in range(warmup):
+        fn({})
+    latency = LatencyStats(window=iterations)
+    stages = StageStats(window=iterations)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        timings = {}
+        call_started = time.perf_counter()
+        fn(timings)
+        latency.record((time.perf_counter() - call_started) * 1000.0)
+        stages.record(timings)
+    elapsed = time.perf_counter() - started
+
+    result = {"name": name, "params": params or {}, **latency.summary()}
+    result["throughput_per_s"] = round(iterations / elapsed, 2) if elapsed > 0 else None
+    result["stages"] = stages.summary()
+    print(f"{name:<44} p50={result['p50_ms']:>9.3f}ms p95={result['p95_ms']:>9.3f}ms "
+          f"p99={result['p99_ms']:>9.3f}ms {result['throughput_per_s']:>9.1f}/s")
+    return result
+
+def pipeline_cases(args):
+    results = []
+    for width, height in args.sizes:
+        image_data = synthetic_frame(width, height)
+        image_url = data_url(image_data)
+        size = f"{width}x{height}"
+
+        results.append(run_case(
+            f"encode_face_from_base64[{size}]",
+            lambda timings: face_system.encode_face_from_base64(image_url, timings),
+            args.iterations, {"size": size}
+        ))
+        results.append(run_case(
+            f"detect_face_in_image[{size}]",
+            lambda timings: face_system.detect_face_in_image(image_url, timings),
+            args.iterations, {"size": size}
+        ))
+        results.append(run_case(
+            f"detect_then_encode[{size}]",
+            lambda timings: detect_then_encode(image_url, timings),
+            args.iterations, {"size": size}
+        ))
+        for faces in args.faces:
+            boxes = face_boxes(width, height, faces)
+            results.append(run_case(
+                f"encode_faces_at[{size},faces={faces}]",
+                lambda timings: face_system.encode_faces_at(image_data, boxes, timings),
+                args.iterations, {"size": size, "faces": faces}
+            ))
+
+    for path in args.images:
+        with open(path, "rb") as f:
+            image_url = data_url(f.read())
+        name = os.path.basename(path)
+        results.append(run_case(
+            f"encode_face_from_base64[{name}]",
+            lambda timings: face_system.encode_face_from_base64(image_url, timings),
+            args.iterations, {"image": name}
+        ))
+    return results
+
+def compare_cases(args):
+    rng = np.random.default_rng(0)
+    results = []
+
+    known, probe = rng.normal(0.0, 0.08, size=(2, 128))
+    results.append(run_case(
+        "compare_faces",
+        lambda timings: face_system.compare_faces(known, probe),
+        args.iterations * 10
+    ))
+
+    for gallery_size in args.gallery_sizes:
+        gallery = FaceGallery()
+        encodings = rng.normal(0.0, 0.08, size=(gallery_size, 128)).astype(np.float32)
+        started = time.perf_counter()
+        gallery.build(np.arange(gallery_size), encodings)
+        # Whole-gallery searches use the IVF index past FACE_ANN_MIN_SIZE;
+        # build it up front instead of on the first timed search
+        gallery.build_index()
+        build_ms = (time.perf_counter() - started) * 1000.0
+        probes = encodings[rng.choice(gallery_size, 64)] + rng.normal(0.0, 0.01, size=(64, 128)).astype(np.float32)
+        probe_iter = iter(range(1 << 62))
+
+        result = run_case(
+            f"identify_all[gallery={gallery_size}]",
+            lambda timings: gallery.identify(probes[next(probe_iter) % len(probes)]),
+            args.iterations * 10, {"gallery": gallery_size}
+        )
+        result["build_ms"] = round(build_ms, 3)
+        results.append(result)
+
+        # What the endpoints run: identification within one class roster
+        roster = rng.choice(gallery_size, min(args.roster_size, gallery_size), replace=False)
+        for user_id in roster.tolist():
+            gallery.enroll(1, user_id)
+        roster_probes = encodings[roster] + rng.normal(0.0, 0.01, size=(len(roster), 128)).astype(np.float32)
+        results.append(run_case(
+            f"identify_class[gallery={gallery_size},roster={len(roster)}]",
+            lambda timings: gallery.identify(roster_probes[next(probe_iter) % len(roster_probes)], class_id=1),
+            args.iterations * 10, {"gallery": gallery_size, "roster": len(roster)}
+        ))
+    return results
+
+def compare_to(baseline_path, results):
+    with open(baseline_path) as f:
+        baseline = {case["name"]: case for case in json.load(f)["cases"]}
+    print(f"\nchange vs {baseline_path}")
+    for case in results:
+        before = baseline.get(case["name"])
+        if before is None:
+            continue
+        deltas = []
+        for key in ("p50_ms", "p99_ms"):
+            if before.get(key):
+                deltas.append(f"{key[:3]} {100.0 * (case[key] - before[key]) / before[key]:+7.1f}%")
+        print(f"{case['name']:<44} " + "  ".join(deltas))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=parse_size, nargs="+", default=[(640, 480), (1280, 720), (1920, 1080), (4032, 3024)])
+    parser.add_argument("--faces", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--gallery-sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--roster-size", type=int, default=40)
+    parser.add_argument("--iterations", type=int, default=30)
+    parser.add_argument("--images", nargs="*", default=[], help="Photo files or directories to time on real faces")
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--compare", help="Print the change against an earlier --json file")
+    args = parser.parse_args()
+
+    images = []
+    for path in args.images:
+        if os.path.isdir(path):
+            images.extend(sorted(p for p in glob.glob(os.path.join(path, "*")) if p.lower().endswith((".jpg", ".jpeg", ".png"))))
+        else:
+            images.append(path)
+    args.images = images
+
+    results = pipeline_cases(args) + compare_cases(args)
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "detection_model": FACE_DETECTION_MODEL,
+            "detection_width": FACE_DETECTION_WIDTH
+        },
+        "iterations": args.iterations,
+        "cases": results
+    }
+
+    if args.compare:
+        compare_to(args.compare, results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
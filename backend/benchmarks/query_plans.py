@@ -0,0 +1,68 @@
+"""Check that the attendance hot queries are answered from their indexes
+
+Run from the backend directory against the configured database:
+
+    python -m benchmarks.query_plans
+
+Each query is compiled from the same ORM expression the endpoints use and
+passed through EXPLAIN QUERY PLAN; the script exits non-zero if any plan
+scans the table or uses a different index than expected. SQLite only.
+"""
+import sys
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func
+
+from app.database import engine, SessionLocal, Attendance, Enrollment
+
+def hot_queries(db):
+    since = datetime.utcnow() - timedelta(hours=1)
+    return [
+        ("duplicate check", "ix_attendances_user_class_time", db.query(Attendance).filter(
+            Attendance.user_id == 1,
+            Attendance.class_id == 1,
+            Attendance.timestamp > since
+        ).limit(1)),
+        ("group duplicate check", "ix_attendances_user_class_time", db.query(Attendance.user_id).filter(
+            Attendance.user_id.in_([1, 2, 3]),
+            Attendance.class_id == 1,
+            Attendance.timestamp > since
+        ).distinct()),
+        ("class attendance", "ix_attendances_class_time", db.query(Attendance).filter(
+            Attendance.class_id == 1
+        ).order_by(Attendance.timestamp.desc())),
+        ("enrollment check", "ux_enrollments_user_class", db.query(Enrollment).filter(
+            Enrollment.user_id == 1,
+            Enrollment.class_id == 1
+        ).limit(1)),
+        ("daily trend", "ix_attendances_time", db.query(func.count(Attendance.id)).filter(
+            and_(Attendance.timestamp >= since, Attendance.timestamp <= datetime.utcnow())
+        )),
+    ]
+
+def query_plan(conn, query):
+    compiled = query.statement.compile(engine, compile_kwargs={"literal_binds": True})
+    return [row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}")]
+
+def main():
+    if engine.dialect.name != "sqlite":
+        print(f"EXPLAIN QUERY PLAN checks are SQLite only, not {engine.dialect.name}")
+        return 0
+
+    failures = 0
+    db = SessionLocal()
+    try:
+        with engine.connect() as conn:
+            for name, index, query in hot_queries(db):
+                plan = query_plan(conn, query)
+                ok = any(index in step for step in plan) and not any(step.startswith("SCAN") and "INDEX" not in step for step in plan)
+                failures += not ok
+                print(f"{'ok  ' if ok else 'FAIL'} {name:<24} expects {index}")
+                for step in plan:
+                    print(f"       {step}")
+    finally:
+        db.close()
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,149 @@
+"""Latency and Python memory of user queries with the face columns deferred or loaded
+
+Run from the backend directory; it builds its own throwaway database:
+
+    python -m benchmarks.user_columns_benchmark --users 10000 --image-kb 60
+
+Each query runs twice: as the app issues it now (face columns deferred)
+and with undefer_group("face"), which is what every User query loaded
+before. Peak memory is measured with tracemalloc, so it counts Python
+allocations (ORM objects and column values), not SQLite's page cache.
+Latency is taken with tracemalloc running, so compare the cases with each
+other rather than with production timings.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+def measure(fn, iterations):
+    from app.metrics import LatencyStats
+
+    fn()
+    latency = LatencyStats(window=iterations)
+    peak = 0
+    for _ in range(iterations):
+        tracemalloc.start()
+        started = time.perf_counter()
+        fn()
+        latency.record((time.perf_counter() - started) * 1000.0)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {**latency.summary(), "peak_mb": round(peak / (1024 * 1024), 2)}
+
+def seed_users(engine, users, image_kb):
+    from app.database import User
+
+    rng = random.Random(0)
+    image = "data:image/jpeg;base64," + base64.b64encode(os.urandom(image_kb * 1024)).decode()
+    rows = [{
+        "username": f"user{index}",
+        "email": f"user{index}@example.com",
+        "full_name": f"User {index}",
+        "hashed_password": "x",
+        "role": "student",
+        "is_active": True,
+        "face_image": image,
+        "face_encoding": json.dumps([rng.gauss(0.0, 0.08) for _ in range(128)])
+    } for index in range(users)]
+    with engine.begin() as conn:
+        conn.execute(User.__table__.insert(), rows)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--image-kb", type=int, default=60, help="Size of each stored face photo before base64")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="user_columns_")
+    # Must be set before the app modules create their engine and gallery
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["FACE_GALLERY_SNAPSHOT_DIR"] = os.path.join(workdir, "face_gallery")
+
+    from fastapi.testclient import TestClient
+    from sqlalchemy.orm import undefer_group
+    from app.auth import create_user_tokens, get_user, load_principal
+    from app.database import engine, SessionLocal, User
+    from app.simple_main_no_face import app
+
+    started = time.perf_counter()
+    seed_users(engine, args.users, args.image_kb)
+    print(f"seeded {args.users} users with {args.image_kb} KB photos in {time.perf_counter() - started:.1f}s")
+
+    names = [f"user{index}" for index in range(args.users)]
+    rng = random.Random(1)
+
+    def list_users(*options):
+        def run():
+            db = SessionLocal()
+            try:
+                return [(user.id, user.username, user.email, user.full_name, user.role, user.is_active)
+                        for user in db.query(User).options(*options).all()]
+            finally:
+                db.close()
+        return run
+
+    def get_user_with_face(db, username):
+        # The pre-deferral get_user
+        return db.query(User).options(undefer_group("face")).filter(User.username == username).first()
+
+    def lookup(find):
+        def run():
+            db = SessionLocal()
+            try:
+                for _ in range(100):
+                    find(db, rng.choice(names))
+                    db.expunge_all()
+            finally:
+                db.close()
+        return run
+
+    results = []
+    cases = [
+        ("list users, deferred", list_users()),
+        ("list users, face columns loaded", list_users(undefer_group("face"))),
+        ("100x get_user, deferred", lookup(get_user)),
+        ("100x get_user, face columns loaded", lookup(get_user_with_face)),
+        ("100x load_principal", lookup(load_principal)),
+    ]
+
+    with TestClient(app) as client:
+        db = SessionLocal()
+        try:
+            admin = User(username="bench-admin", email="admin@example.com", full_name="Admin", hashed_password="x", role="admin", is_active=True)
+            db.add(admin)
+            db.commit()
+            headers = {"Authorization": "Bearer " + create_user_tokens(admin)["access_token"]}
+        finally:
+            db.close()
+
+        def get(path):
+            def run():
+                response = client.get(path, headers=headers)
+                assert response.status_code == 200, response.text
+            return run
+
+        cases += [
+            ("GET /users", get("/users")),
+            ("GET /users/me", get("/users/me")),
+        ]
+        for name, fn in cases:
+            result = {"name": name, **measure(fn, args.iterations)}
+            results.append(result)
+            print(f"{name:<38} p50={result['p50_ms']:>9.1f}ms p95={result['p95_ms']:>9.1f}ms peak={result['peak_mb']:>8.1f}MB")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"users": args.users, "image_kb": args.image_kb, "iterations": args.iterations, "cases": results}, f, indent=2)
+    engine.dispose()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()